@@ -1,7 +1,7 @@
-from .caching import CachedProperty
+from .caching import CachedProperty, CachedMethod
 from .magic_contract import magic_contract
 from .opt_decorator import optional_argument_decorator
-from .progress_bar import progbar, parallel_progbar, iparallel_progbar
+from .progress_bar import progbar, parallel_progbar, iparallel_progbar, parallel_first, parallel_any, parallel_all
 from .py2_wrap import MakePython2
 from .timing import timed_call, make_timed, tic
 from . import logs_base as logger
@@ -0,0 +1,306 @@
+"""A small benchmark harness: register benchmarks with ``@benchmark``, run them with warmup and automatically calibrated
+repetitions, summarize them with outlier-robust statistics, and compare them against a stored baseline.
+
+Run every benchmark registered by some modules (or files) from the command line with::
+
+    python -m miniutils.bench my_benchmarks.py --baseline baseline.json --save results.json
+"""
+import argparse
+from collections import OrderedDict
+import datetime
+import fnmatch
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import sys
+from time import perf_counter_ns
+
+from miniutils.timing import TimingStats
+
+# Every registered benchmark, by name
+benchmarks = OrderedDict()
+
+
+class BenchmarkRegression(AssertionError):
+    """Raised when benchmarks have gotten slower than their baseline allows"""
+
+
+class Benchmark:
+    def __init__(self, func, name=None, setup=None):
+        """A function to benchmark. Its run time is measured over many calls, so it should do the same work each time
+
+        :param func: The function to benchmark (called with no arguments, or with the return value of ``setup``)
+        :param name: The benchmark's name (defaults to the function's qualified name)
+        :param setup: A function whose return value is passed to ``func`` on every call. It's called once per
+         repetition, and isn't timed
+        """
+        self.func = func
+        self.name = name or '{}.{}'.format(func.__module__, func.__qualname__)
+        self.setup = setup
+
+    def _time(self, loops):
+        """Times ``loops`` calls, returning the total in nanoseconds"""
+        func = self.func
+        if self.setup is not None:
+            arg = self.setup()
+            start = perf_counter_ns()
+            for _ in range(loops):
+                func(arg)
+        else:
+            start = perf_counter_ns()
+            for _ in range(loops):
+                func()
+        return perf_counter_ns() - start
+
+    def calibrate(self, target):
+        """Finds how many calls it takes for a repetition to last at least ``target`` seconds
+
+        :param target: The minimum time per repetition, in seconds
+        :return: The number of calls per repetition
+        """
+        loops = 1
+        while True:
+            elapsed = self._time(loops) / 1e9
+            if elapsed >= target or loops >= 1 << 30:
+                return loops
+            # Jump most of the way there, but never by more than a factor of 10 (the first runs may be noisy)
+            loops = int(loops * min(10, max(2, target / max(elapsed, 1e-9) * 1.2)))
+
+    def run(self, repeat=7, min_time=0.1, warmup=0.05):
+        """Runs the benchmark
+
+        :param repeat: The number of repetitions to time
+        :param min_time: The minimum time per repetition, in seconds (calls per repetition are calibrated to match)
+        :param warmup: How long to run the benchmark before timing it (to warm caches, JITs, and lazy imports)
+        :return: The ``BenchmarkResult``
+        """
+        if warmup:
+            deadline = perf_counter_ns() + warmup * 1e9
+            while perf_counter_ns() < deadline:
+                self._time(1)
+        loops = self.calibrate(min_time)
+        stats = TimingStats(self.name)
+        times = []
+        for _ in range(repeat):
+            per_call = self._time(loops) / loops
+            stats.record(int(per_call))
+            times.append(per_call / 1e9)
+        return BenchmarkResult(self.name, loops, times, stats)
+
+
+def benchmark(func=None, name=None, setup=None):
+    """Registers a function as a benchmark (usable as ``@benchmark`` or ``@benchmark(name=..., setup=...)``). See
+    ``Benchmark`` for the parameters. The function itself is returned unchanged"""
+    def register(f):
+        bench = Benchmark(f, name, setup)
+        benchmarks[bench.name] = bench
+        return f
+
+    return register(func) if func is not None else register
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def _quantile(values, q):
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class BenchmarkResult:
+    """The timings of a benchmark run: the time per call of each repetition, in seconds, summarized with statistics that
+    aren't thrown off by a few noisy repetitions (the median, and the median absolute deviation). Freshly run results
+    also keep the repetitions in a ``TimingStats`` as ``stats``, for its percentiles and summary"""
+
+    def __init__(self, name, loops, times, stats=None):
+        self.name = name
+        self.loops = loops
+        self.times = list(times)
+        self.stats = stats
+
+    @property
+    def median(self):
+        return _median(self.times)
+
+    @property
+    def mad(self):
+        """The median absolute deviation from the median, scaled to be comparable to a standard deviation"""
+        median = self.median
+        return 1.4826 * _median([abs(t - median) for t in self.times])
+
+    @property
+    def iqr(self):
+        """The interquartile range"""
+        return _quantile(self.times, 0.75) - _quantile(self.times, 0.25)
+
+    @property
+    def min(self):
+        return min(self.times)
+
+    @property
+    def mean(self):
+        return sum(self.times) / len(self.times)
+
+    @property
+    def outliers(self):
+        """The number of repetitions more than 3 (scaled) median absolute deviations from the median"""
+        median, mad = self.median, self.mad
+        return sum(abs(t - median) > 3 * mad for t in self.times) if mad else 0
+
+    def to_dict(self):
+        return OrderedDict([('loops', self.loops), ('times', self.times), ('median', self.median), ('mad', self.mad),
+                            ('iqr', self.iqr), ('min', self.min), ('mean', self.mean), ('outliers', self.outliers)])
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(name, data['loops'], data['times'])
+
+    def __repr__(self):
+        return '<BenchmarkResult {} median={:0.3e}s mad={:0.3e}s loops={} repeat={}>'.format(
+            self.name, self.median, self.mad, self.loops, len(self.times))
+
+
+def run_all(pattern=None, repeat=7, min_time=0.1, warmup=0.05):
+    """Runs every registered benchmark (or those whose names match a pattern)
+
+    :param pattern: A glob-style pattern to filter benchmark names with (e.g., ``'*caching*'``)
+    :return: A dictionary of benchmark name to ``BenchmarkResult``
+    """
+    return OrderedDict((name, bench.run(repeat=repeat, min_time=min_time, warmup=warmup))
+                       for name, bench in benchmarks.items() if pattern is None or fnmatch.fnmatch(name, pattern))
+
+
+def save_results(results, path):
+    """Saves benchmark results (along with a description of the machine they ran on) as JSON
+
+    :param results: A dictionary of benchmark name to ``BenchmarkResult``
+    :param path: The file to write
+    """
+    data = OrderedDict([
+        ('created', datetime.datetime.now().isoformat()),
+        ('python', sys.version),
+        ('platform', platform.platform()),
+        ('benchmarks', OrderedDict((name, result.to_dict()) for name, result in results.items())),
+    ])
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def load_results(path):
+    """Loads benchmark results saved by ``save_results``
+
+    :param path: The file to read
+    :return: A dictionary of benchmark name to ``BenchmarkResult``
+    """
+    with open(path) as f:
+        data = json.load(f)
+    return OrderedDict((name, BenchmarkResult.from_dict(name, result))
+                       for name, result in data['benchmarks'].items())
+
+
+class Comparison:
+    """How a benchmark's result compares to its baseline"""
+
+    def __init__(self, name, baseline, result, tolerance):
+        self.name = name
+        self.baseline = baseline
+        self.result = result
+        self.ratio = result.median / baseline.median if baseline.median else float('inf')
+        # A regression has to be beyond the tolerance, and beyond the noise of both runs
+        noise = 2 * max(baseline.mad, result.mad)
+        self.regressed = self.ratio > 1 + tolerance and result.median - baseline.median > noise
+
+    def __repr__(self):
+        return '<Comparison {} {:0.3f}x{}>'.format(self.name, self.ratio, ' REGRESSED' if self.regressed else '')
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compares benchmark results against a baseline
+
+    :param results: A dictionary of benchmark name to ``BenchmarkResult``
+    :param baseline: The baseline results, in the same form (benchmarks missing from either are skipped)
+    :param tolerance: How much slower (as a fraction of the baseline's median) a benchmark can get before it counts as
+     a regression
+    :return: A list of ``Comparison``
+    """
+    return [Comparison(name, baseline[name], result, tolerance) for name, result in results.items()
+            if name in baseline]
+
+
+def assert_no_regressions(results, baseline, tolerance=0.1):
+    """Raises ``BenchmarkRegression`` if any benchmark regressed beyond the tolerance (see ``compare``)"""
+    regressed = [c for c in compare(results, baseline, tolerance) if c.regressed]
+    if regressed:
+        raise BenchmarkRegression('Benchmarks regressed: ' + ', '.join(
+            '{} ({:0.2f}x slower)'.format(c.name, c.ratio) for c in regressed))
+
+
+def report(results, baseline=None, tolerance=0.1):
+    """Formats benchmark results as a table, one benchmark per line, including the change from a baseline if given
+
+    :return: The report, as a string
+    """
+    comparisons = {c.name: c for c in compare(results, baseline, tolerance)} if baseline else {}
+    lines = ['{:<50} {:>12} {:>12} {:>10} {:>8} {:>12}'.format(
+        'benchmark', 'median (s)', 'mad (s)', 'loops', 'outliers', 'vs baseline')]
+    for name, result in results.items():
+        c = comparisons.get(name)
+        change = '' if c is None else '{:0.3f}x{}'.format(c.ratio, ' !' if c.regressed else '')
+        lines.append('{:<50} {:>12.4e} {:>12.4e} {:>10} {:>8} {:>12}'.format(
+            name, result.median, result.mad, result.loops, result.outliers, change))
+    return '\n'.join(lines)
+
+
+def _load_benchmarks(target):
+    """Imports a module (by name) or a Python file (by path), registering any benchmarks it defines"""
+    if os.path.exists(target):
+        module_name = '_miniutils_bench_' + os.path.splitext(os.path.basename(target))[0]
+        spec = importlib.util.spec_from_file_location(module_name, target)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    else:
+        importlib.import_module(target)
+
+
+def main(argv=None):
+    """Runs registered benchmarks from the command line, returning a nonzero exit code if any regressed"""
+    parser = argparse.ArgumentParser(prog='python -m miniutils.bench', description=main.__doc__)
+    parser.add_argument('modules', nargs='*', help='Modules or Python files that define benchmarks')
+    parser.add_argument('-k', '--filter', help='Only run benchmarks whose names match this glob pattern')
+    parser.add_argument('--repeat', type=int, default=7, help='Repetitions per benchmark')
+    parser.add_argument('--min-time', type=float, default=0.1, help='Minimum seconds per repetition')
+    parser.add_argument('--warmup', type=float, default=0.05, help='Seconds to run each benchmark before timing it')
+    parser.add_argument('--baseline', help='Results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed slowdown relative to the baseline, as a fraction')
+    parser.add_argument('--save', help='File to save the results to')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    for target in args.modules:
+        _load_benchmarks(target)
+    results = run_all(args.filter, repeat=args.repeat, min_time=args.min_time, warmup=args.warmup)
+    baseline = load_results(args.baseline) if args.baseline else None
+    print(report(results, baseline, args.tolerance))
+    if args.save:
+        save_results(results, args.save)
+    if baseline:
+        try:
+            assert_no_regressions(results, baseline, args.tolerance)
+        except BenchmarkRegression as e:
+            print(e, file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,135 @@
+import asyncio
+from collections import OrderedDict, deque, namedtuple
+import concurrent.futures
 import functools
-#from contextlib import contextmanager
-from threading import RLock
+import hashlib
+import heapq
+import inspect
+import os
+import pickle
+from contextlib import contextmanager
+import sys
+import tempfile
+from threading import Condition, Lock, RLock, Thread
+from time import monotonic, perf_counter
+import types
+import warnings
+import weakref
 #import inspect
 
 
+class _Missing:
+    """Marks a cached value that hasn't been computed yet (or has been invalidated). It's a singleton, even when
+    pickled or copied"""
+
+    def __reduce__(self):
+        return '_MISSING'
+
+    def __repr__(self):
+        return '<missing>'
+
+
+_MISSING = _Missing()
+
+# Locks are tagged with the generation of the process that made them. A forked child starts a new generation, since
+# any lock that another thread held at the time of the fork would stay locked forever in the child
+_generation = object()
+
+# The global memory budget for computed cached property values, or None if unlimited
+_memory_budget = None
+# Whether cached properties are currently collecting usage statistics
+_collect_stats = False
+# Whether anything needs to observe cache hits (i.e., either of the above are enabled)
+_observing = False
+
+# The background thread that refreshes stale values and expires dependents (see _Refresher), once it's needed
+_refresher = None
+
+# Instances with invalidations currently deferred by CachedProperty.batch: id(instance) -> [depth, pending sources]
+_batches = {}
+_batches_lock = Lock()
+
+
+# Per-type tables of the methods that can't change a collection's contents, and of those that can. Types are keyed
+# directly, or by "module.name" for optional dependencies. Methods and attributes that return views of an array (e.g.,
+# ``reshape`` or ``T``) count as changes, since writing through the view changes the cached array
+_READ_ONLY_METHODS = {
+    list: frozenset(['copy', 'count', 'index']),
+    dict: frozenset(['copy', 'fromkeys', 'get', 'items', 'keys', 'values', 'default_factory']),
+    set: frozenset(['copy', 'difference', 'intersection', 'isdisjoint', 'issubset', 'issuperset',
+                    'symmetric_difference', 'union']),
+    frozenset: frozenset(['copy', 'difference', 'intersection', 'isdisjoint', 'issubset', 'issuperset',
+                          'symmetric_difference', 'union']),
+    deque: frozenset(['copy', 'count', 'index']),
+    'numpy.ndarray': frozenset(['all', 'any', 'argmax', 'argmin', 'argpartition', 'argsort', 'astype', 'choose',
+                                'clip', 'compress', 'conj', 'conjugate', 'copy', 'cumprod', 'cumsum', 'dot', 'dump',
+                                'dumps', 'flatten', 'item', 'max', 'mean', 'min', 'nonzero', 'prod', 'ptp', 'repeat',
+                                'round', 'searchsorted', 'std', 'sum', 'take', 'to_device', 'tobytes', 'tofile',
+                                'tolist', 'tostring', 'trace', 'var']),
+}
+_MUTATING_METHODS = {
+    list: frozenset(['append', 'clear', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort']),
+    dict: frozenset(['clear', 'move_to_end', 'pop', 'popitem', 'setdefault', 'update']),
+    set: frozenset(['add', 'clear', 'difference_update', 'discard', 'intersection_update', 'pop', 'remove',
+                    'symmetric_difference_update', 'update']),
+    frozenset: frozenset(),
+    deque: frozenset(['append', 'appendleft', 'clear', 'extend', 'extendleft', 'insert', 'pop', 'popleft', 'remove',
+                      'reverse', 'rotate']),
+    'numpy.ndarray': frozenset(['byteswap', 'fill', 'itemset', 'newbyteorder', 'partition', 'put', 'resize',
+                                'setfield', 'setflags', 'sort',
+                                # These return views
+                                'diagonal', 'getfield', 'ravel', 'reshape', 'squeeze', 'swapaxes', 'transpose',
+                                'view', 'T', 'base', 'data', 'flat', 'imag', 'real']),
+}
+_method_tables = {}
+
+
+def _collection_methods(cls):
+    """Finds the read-only and mutating method tables for a collection type (or its nearest tabulated base class), or
+    None if it has none"""
+    try:
+        return _method_tables[cls]
+    except KeyError:
+        pass
+    tables = None
+    for klass in cls.__mro__:
+        key = klass if klass in _READ_ONLY_METHODS else '{}.{}'.format(klass.__module__, klass.__qualname__)
+        if key in _READ_ONLY_METHODS:
+            tables = _READ_ONLY_METHODS[key], _MUTATING_METHODS[key]
+            break
+    _method_tables[cls] = tables
+    return tables
+
+
+Mutation = namedtuple('Mutation', ['source', 'method', 'args', 'kwargs', 'previous'])
+Mutation.__doc__ = """A change made to a cached collection: the name of the collection's property, the method called on
+it (e.g., 'append', or '__setitem__' and '__delitem__' for item assignment and deletion), its arguments, and the value
+that was overwritten or deleted (for item assignment and deletion; otherwise None)"""
+
+
 class CachedCollection:
+    # Methods assumed to be read-only on collection types that don't have their own table
     IGNORED_GETS = ['get', 'union', 'intersection', 'difference', 'copy']
 
     def __init__(self, value, on_update, container_self, allow_update):
         self.collection = value
-        self.on_update = lambda: on_update(container_self)
+        # Called with a description of the change (method name, args, kwargs, and the value it displaced), or with
+        # nothing if the change can't be described
+        self.on_update = lambda *mutation: on_update(container_self, *mutation)
         self.allow_update = allow_update
 
+    def _displaced(self, key):
+        """Finds the value currently at ``key``, before it gets overwritten or deleted"""
+        try:
+            if hasattr(self.collection, 'keys'):
+                # Don't trigger a defaultdict's default factory
+                return self.collection.get(key)
+            previous = self.collection[key]
+        except (IndexError, KeyError, TypeError):
+            return None
+        # Slices of arrays are views, which are about to change
+        return previous.copy() if type(previous) is type(self.collection) else previous
+
     def __getitem__(self, item):
         return self.collection[item]
 
@@ -24,14 +142,16 @@ class CachedCollection:
     def __setitem__(self, key, value):
         if not self.allow_update:
             raise AttributeError("Attempted to set value in an immutable cached collection")
+        previous = self._displaced(key)
         self.collection[key] = value
-        self.on_update()
+        self.on_update('__setitem__', (key, value), {}, previous)
 
     def __delitem__(self, key):
         if not self.allow_update:
             raise AttributeError("Attempted to delete item from an immutable cached collection")
+        previous = self._displaced(key)
         del self.collection[key]
-        self.on_update()
+        self.on_update('__delitem__', (key,), {}, previous)
 
     def __iter__(self):
         return iter(self.collection)
@@ -53,12 +173,24 @@ class CachedCollection:
 
     def __getattr__(self, item):
         res = getattr(self.collection, item)
-
-        # TODO: make this more robust somehow... but how without deep copy and equality compare?
-        # e.g., how to detect that dict().update changes its underlying data?
-        # For now, manually annotate methods which are incapable of changing underlying data, and assume all others do
-        if item in self.IGNORED_GETS:
+        tables = _collection_methods(type(self.collection))
+        if not callable(res):
+            # Plain attributes (e.g., an array's shape) might change, so don't cache them. Most can't modify anything,
+            # but views (e.g., an array's ``T``) can be written through
+            if tables is not None and item in tables[1]:
+                if not self.allow_update:
+                    raise AttributeError("Attempted to modify an immutable cached collection (through {})".format(item))
+                self.on_update(item, (), {}, None)
             return res
+
+        # We can't detect whether an arbitrary method changes the underlying data (without a deep copy and equality
+        # compare), so known collection types have tables of their read-only and mutating methods, and anything else
+        # is assumed to modify the collection
+        if tables is not None and item not in tables[0] and item not in tables[1]:
+            warnings.warn("{}.{} isn't known to be read-only, so calling it on a cached collection invalidates its "
+                          "dependents".format(type(self.collection).__name__, item))
+        if item in (self.IGNORED_GETS if tables is None else tables[0]):
+            wrapped_res = res
         else:
             @functools.wraps(res)
             def wrapped_res(*args, **kwargs):
@@ -66,10 +198,12 @@ class CachedCollection:
                     raise AttributeError("Attempted to modify an immutable cached collection (in call to {})"
                                          .format(res.__name__))
                 r = res(*args, **kwargs)
-                self.on_update()
+                self.on_update(item, args, kwargs, None)
                 return r
 
-            return wrapped_res
+        # The wrapped collection never changes, so remember this method to skip __getattr__ on later calls
+        self.__dict__[item] = wrapped_res
+        return wrapped_res
 
 
 # TODO: Created a CachedAttribute/functional version of this, e.g. to use in the constructor
@@ -78,12 +212,933 @@ class CachedCollection:
 # You'll need to pull in the 'self' from the frame in which CachedAttribute gets called
 # The upside is that you shrink essentially a 3-liner into a 1-liner for simple cases
 
-# TODO: Create a general purpose decorator that just allows other properties or methods to fit into the dependency chain
+class _AttributeStorage:
+    """Stores a cached value as separate instance attributes: ``_<name>`` holds the value, ``_need_<name>`` flags it
+    for re-computation, and ``_lock_<name>`` guards its computation.
+
+    The value attribute only exists while the value is valid, so a cache hit is a single attribute read. The flag is
+    kept up to date for introspection, but is never consulted."""
+
+    def __init__(self, name):
+        self.cache_name = '_' + name
+        self.flag_name = '_need_' + name
+        self.lock_name = '_lock_' + name
+
+    def load(self, inst):
+        return getattr(inst, self.cache_name, _MISSING)
+
+    def store(self, inst, value):
+        setattr(inst, self.cache_name, value)
+        setattr(inst, self.flag_name, False)
+
+    def clear(self, inst):
+        """Drops the cached value, returning whether there was one"""
+        # Remove the value before raising the flag, so that lock-free readers never see a stale value
+        try:
+            delattr(inst, self.cache_name)
+            existed = True
+        except AttributeError:
+            existed = False
+        setattr(inst, self.flag_name, True)
+        if existed and _memory_budget is not None:
+            _memory_budget.forget(inst, self)
+        return existed
+
+    def lock(self, inst):
+        entry = getattr(inst, self.lock_name, None)
+        if entry is None or entry[0] is not _generation:
+            with _creation_lock:
+                entry = getattr(inst, self.lock_name, None)
+                if entry is None or entry[0] is not _generation:
+                    entry = vars(inst)[self.lock_name] = (_generation, RLock())
+        return entry[1]
+
+    def export(self, inst, state, compact, exported):
+        """Prepares this value for pickling or copying, given the instance's (copied) state
+
+        :param inst: The instance being pickled
+        :param state: A copy of the instance's ``__dict__``, which is edited in place
+        :param compact: The instance's compact values by name, which is added to in place
+        :param exported: A function that converts the cached value to what should be pickled (``_MISSING`` to drop it)
+        """
+        state.pop(self.lock_name, None)
+        value = state.get(self.cache_name, _MISSING)
+        if value is not _MISSING:
+            value = exported(value)
+            if value is _MISSING:
+                del state[self.cache_name]
+                state[self.flag_name] = True
+            else:
+                state[self.cache_name] = value
+
+
+# Compact storage keeps all of an instance's cached values in a single list. Slot 0 holds the instance's lock (shared
+# by all of its compact properties, tagged with its generation), and each property gets a fixed index per class (in
+# order of first use, so indices differ between processes, and values are pickled by name instead). The list lives in
+# the ``_cached_values`` attribute (declare it in ``__slots__`` for slotted classes), or in a side table keyed by id
+# when the instance can't hold it.
+_COMPACT_ATTRIBUTE = '_cached_values'
+_compact_layouts = weakref.WeakKeyDictionary()
+_compact_side_table = {}
+_creation_lock = Lock()
+
+
+def _compact_index(cls, name):
+    with _creation_lock:
+        layout = _compact_layouts.get(cls)
+        if layout is None:
+            layout = _compact_layouts[cls] = {}
+        return layout.setdefault(name, len(layout) + 1)
+
+
+def _compact_values(inst):
+    try:
+        return getattr(inst, _COMPACT_ATTRIBUTE)
+    except AttributeError:
+        pass
+    key = id(inst)
+    values = _compact_side_table.get(key)
+    if values is not None:
+        return values
+
+    with _creation_lock:
+        values = _compact_side_table.get(key, getattr(inst, _COMPACT_ATTRIBUTE, None))
+        if values is None:
+            values = [None]
+            try:
+                setattr(inst, _COMPACT_ATTRIBUTE, values)
+            except AttributeError:
+                try:
+                    weakref.finalize(inst, _compact_side_table.pop, key, None)
+                except TypeError:
+                    raise TypeError("Compact cached properties on {} need either '{}' or '__weakref__' in its "
+                                    "__slots__".format(type(inst).__name__, _COMPACT_ATTRIBUTE))
+                _compact_side_table[key] = values
+        return values
+
+
+class _CompactStorage:
+    """Stores a cached value in the instance's shared compact list of cached values"""
+
+    def __init__(self, name):
+        self.name = name
+        self.indices = {}
+
+    def _index(self, inst):
+        cls = type(inst)
+        try:
+            return self.indices[cls]
+        except KeyError:
+            index = self.indices[cls] = _compact_index(cls, self.name)
+            return index
+
+    def load(self, inst):
+        try:
+            return getattr(inst, _COMPACT_ATTRIBUTE)[self.indices[type(inst)]]
+        except (AttributeError, KeyError, IndexError):
+            pass
+        values = _compact_values(inst)
+        index = self._index(inst)
+        return values[index] if index < len(values) else _MISSING
+
+    def store(self, inst, value):
+        values = _compact_values(inst)
+        index = self._index(inst)
+        if index >= len(values):
+            values.extend([_MISSING] * (index + 1 - len(values)))
+        values[index] = value
+
+    def clear(self, inst):
+        values = _compact_values(inst)
+        index = self._index(inst)
+        if index < len(values) and values[index] is not _MISSING:
+            values[index] = _MISSING
+            if _memory_budget is not None:
+                _memory_budget.forget(inst, self)
+            return True
+        return False
+
+    def lock(self, inst):
+        values = _compact_values(inst)
+        entry = values[0]
+        if entry is None or entry[0] is not _generation:
+            with _creation_lock:
+                entry = values[0]
+                if entry is None or entry[0] is not _generation:
+                    entry = values[0] = (_generation, RLock())
+        return entry[1]
+
+    def export(self, inst, state, compact, exported):
+        value = self.load(inst)
+        if value is not _MISSING:
+            value = exported(value)
+            if value is not _MISSING:
+                compact[self.name] = value
+
+
+_attribute_deleters = {}
+
+
+def _delete_attribute(name):
+    """Makes the reset for an affected name that isn't a cached value (shared, so that batches can de-duplicate it)"""
+    try:
+        return _attribute_deleters[name]
+    except KeyError:
+        def reset(inst):
+            try:
+                delattr(inst, name)
+            except AttributeError:
+                # Plain attributes aren't always set (e.g., when nothing upstream was ever computed)
+                pass
+
+        return _attribute_deleters.setdefault(name, reset)
+
+
+def _find_dependency_cycles(graph):
+    """Finds the cycles in a directed graph (given as a dictionary of node to successors), as lists of nodes"""
+    cycles = []
+    state = {}  # Missing = unvisited, True = on the current path, False = finished
+    path = []
+
+    def visit(node):
+        state[node] = True
+        path.append(node)
+        for succ in graph.get(node, ()):
+            if state.get(succ) is True:
+                cycles.append(path[path.index(succ):] + [succ])
+            elif succ not in state:
+                visit(succ)
+        path.pop()
+        state[node] = False
+
+    for node in graph:
+        if node not in state:
+            visit(node)
+    return cycles
+
+
+def _cache_nodes(cls):
+    """Finds all cached properties and methods of a class (and its bases), by name"""
+    nodes = {}
+    for klass in reversed(cls.__mro__):
+        for name, attr in vars(klass).items():
+            if isinstance(attr, _CacheNode):
+                nodes[name] = attr
+            else:
+                # A subclass can replace a cached property with something else entirely
+                nodes.pop(name, None)
+    return nodes
+
+
+def _compile_invalidation_plans(cls):
+    """Collects the dependency graph of all cached properties in a class (and its bases), and flattens it into an
+    invalidation plan for each one: the ordered list of resets to apply to an instance when that property changes.
+
+    :param cls: The class to compile plans for
+    :return: A dictionary of property name to its plan (a tuple of functions, each taking the instance)
+    """
+    nodes = _cache_nodes(cls)
+    graph = {name: node.affected_properties for name, node in nodes.items()}
+
+    for cycle in _find_dependency_cycles(graph):
+        warnings.warn("Cached properties of {} have a dependency cycle: {}"
+                      .format(cls.__name__, ' -> '.join(cycle)))
+
+    plans = {}
+    for source in nodes:
+        plans[source] = _resets(nodes, _downstream(graph, graph[source], {source}))
+
+        # When a collection is mutated, its direct dependents that can update incrementally are given a log of the
+        # changes instead of being reset (unless they're also downstream of something that does get reset)
+        dependents = graph[source]
+        incremental = [d for d in dependents if getattr(nodes.get(d), 'updater', None) is not None]
+        if incremental:
+            others = [d for d in dependents if d not in incremental]
+            reset = _downstream(graph, others + [succ for d in incremental for succ in graph[d]], {source})
+            targets = tuple(nodes[d] for d in incremental if d not in reset)
+            nodes[source].incremental_plans[cls] = (targets, _resets(nodes, reset))
+        else:
+            nodes[source].incremental_plans[cls] = None
+
+    for name, node in nodes.items():
+        node.plans[cls] = plans[name]
+    return plans
+
+
+def _downstream(graph, starts, skip):
+    """Lists everything reachable from (and including) the starting nodes, in topological order, without passing
+    through the skipped nodes"""
+    # Reverse post-order of a depth-first search gives a topological order (cycles are simply cut where they close)
+    order = []
+    visited = set(skip)
+
+    def visit(node):
+        if node not in visited:
+            visited.add(node)
+            for succ in graph.get(node, ()):
+                visit(succ)
+            order.append(node)
+
+    for start in starts:
+        visit(start)
+    order.reverse()
+    return order
+
+
+def _resets(nodes, names):
+    return tuple(nodes[name].reset if name in nodes else _delete_attribute(name) for name in names)
+
+
+def _estimate_size(value):
+    """Estimates the memory held by a cached value, in bytes"""
+    if isinstance(value, CachedCollection):
+        value = value.collection
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    return sys.getsizeof(value)
+
+
+class _MemoryBudget:
+    """Tracks the estimated size of every computed cached property value (across all instances), evicting the least
+    recently used values once their total exceeds the budget. Instances are tracked through weak references, so this
+    never keeps anything alive, and an evicted value is simply recomputed on its next access."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        # (id(instance), storage) -> (weak reference to instance, size), from least to most recently used
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def track(self, inst, storage, value):
+        key = (id(inst), storage)
+        size = _estimate_size(value)
+        try:
+            ref = weakref.ref(inst, lambda _: self._discard(key))
+        except TypeError:
+            # Instances that can't be weakly referenced just aren't subject to the budget
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used -= old[1]
+            self.entries[key] = (ref, size)
+            self.used += size
+            victims = self._pop_victims()
+        self._evict(victims)
+
+    def touch(self, inst, storage):
+        try:
+            self.entries.move_to_end((id(inst), storage))
+        except KeyError:
+            pass
+
+    def forget(self, inst, storage):
+        self._discard((id(inst), storage))
+
+    def _discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.used -= entry[1]
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            victims = self._pop_victims()
+        self._evict(victims)
+
+    def _pop_victims(self):
+        victims = []
+        while self.used > self.max_bytes and self.entries:
+            (_, storage), (ref, size) = self.entries.popitem(last=False)
+            self.used -= size
+            victims.append((ref, storage))
+        return victims
+
+    @staticmethod
+    def _evict(victims):
+        for ref, storage in victims:
+            inst = ref()
+            if inst is not None:
+                storage.clear(inst)
+
+
+def _slot_names(cls):
+    """The names of the slots that instances of a class have (other than ``__dict__`` and ``__weakref__``)"""
+    names = []
+    for klass in cls.__mro__:
+        slots = vars(klass).get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for slot in slots:
+            if slot in ('__dict__', '__weakref__'):
+                continue
+            if slot.startswith('__') and not slot.endswith('__'):
+                slot = '_{}{}'.format(klass.__name__.lstrip('_'), slot)
+            names.append(slot)
+    return names
+
+
+def _getstate(self):
+    """Pickles (and copies) an instance with cached values: values are kept unless excluded with ``serialize=False``,
+    and locks are dropped (they're rebuilt when they're next needed)"""
+    state = dict(vars(self)) if hasattr(self, '__dict__') else {}
+    slots = {}
+    for name in _slot_names(type(self)):
+        try:
+            slots[name] = getattr(self, name)
+        except AttributeError:
+            pass
+    state.pop(_COMPACT_ATTRIBUTE, None)
+    slots.pop(_COMPACT_ATTRIBUTE, None)
+
+    compact = {}
+    for node in _cache_nodes(type(self)).values():
+        node.storage.export(self, state, compact, node.exported)
+    if compact:
+        state[_COMPACT_ATTRIBUTE] = compact
+    return (state or None, slots) if slots else state
+
+
+def _setstate(self, state):
+    state, slots = state if isinstance(state, tuple) else (state, None)
+    state = dict(state or ())
+    compact = state.pop(_COMPACT_ATTRIBUTE, {})
+    if state:
+        vars(self).update(state)
+    for name, value in (slots or {}).items():
+        setattr(self, name, value)
+
+    nodes = _cache_nodes(type(self))
+    for name, value in compact.items():
+        nodes[name].storage.store(self, value)
+    for node in nodes.values():
+        node.restore(self)
+
+
+def _make_serializable(cls):
+    """Pickles and copies a class's instances with ``_getstate``/``_setstate``, unless it already handles that itself"""
+    if getattr(cls, '__getstate__', None) in (None, getattr(object, '__getstate__', None)) and \
+            getattr(cls, '__setstate__', None) is None:
+        cls.__getstate__ = _getstate
+        cls.__setstate__ = _setstate
+
+
+def _after_fork():
+    """Replaces every lock that might have been held (by a thread that no longer exists) when the process forked"""
+    global _generation, _creation_lock, _batches_lock, _refresher
+    _generation = object()
+    _creation_lock = Lock()
+    _batches_lock = Lock()
+    # Threads don't survive a fork, and neither do their queues of work
+    _refresher = None
+    if _memory_budget is not None:
+        _memory_budget.lock = Lock()
+    for cache in CachedProperty.caches:
+        cache.stats._lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class _CacheNode:
+    """Base for the descriptors that take part in a class's cached-value dependency graph. Subclasses provide
+    ``name``, ``affected_properties``, ``storage``, ``reset`` (a function that drops an instance's cached value,
+    returning whether there was one), and ``plans`` (a dictionary of class to invalidation plan)"""
+
+    def __set_name__(self, owner, name):
+        # Once the last cached attribute of a class is set up, the class's dependency graph is complete
+        names = [n for n, attr in vars(owner).items() if isinstance(attr, _CacheNode)]
+        if names[-1] == name:
+            _compile_invalidation_plans(owner)
+            _make_serializable(owner)
+
+    def exported(self, value):
+        """Converts a cached value to what should be pickled with its instance (or ``_MISSING`` to leave it out)"""
+        return value
+
+    def restore(self, inst):
+        """Fixes up an instance's cached value after it's been unpickled"""
+
+    def plan(self, cls):
+        try:
+            return self.plans[cls]
+        except KeyError:
+            return _compile_invalidation_plans(cls)[self.name]
+
+    def incremental_plan(self, cls):
+        if cls not in self.incremental_plans:
+            _compile_invalidation_plans(cls)
+        return self.incremental_plans[cls]
+
+    def reset_dependents(self, inst, mutation=None):
+        """Invalidates every cached value that depends on this one, in a single pass (or defers it, if the instance is
+        in a ``CachedProperty.batch``)
+
+        :param inst: The instance whose values to invalidate
+        :param mutation: The ``Mutation`` that was made to this (collection) value, if known, which is passed on to
+         dependents that can update incrementally
+        """
+        if _batches:
+            batch = _batches.get(id(inst))
+            if batch is not None:
+                pending = batch[1]
+                if mutation is None:
+                    pending[self] = None
+                else:
+                    mutations = pending.setdefault(self, [])
+                    if mutations is not None:
+                        mutations.append(mutation)
+                return
+        self.apply_invalidation(inst, None if mutation is None else [mutation])
+
+    def apply_invalidation(self, inst, mutations, applied=None):
+        """Applies this value's invalidation plan to an instance
+
+        :param inst: The instance whose values to invalidate
+        :param mutations: The mutations made to this (collection) value, or None if it was changed in some other way
+        :param applied: A set of resets that have already been applied, and don't need to be repeated
+        """
+        cls = type(inst)
+        plan = self.plan(cls)
+        if mutations is not None:
+            incremental = self.incremental_plan(cls)
+            if incremental is not None:
+                targets, plan = incremental
+                for target in targets:
+                    for mutation in mutations:
+                        target.log_mutation(inst, mutation)
+        for reset in plan:
+            if applied is None:
+                reset(inst)
+            elif reset not in applied:
+                applied.add(reset)
+                reset(inst)
+
+
+class _CachedPropertyDescriptor(_CacheNode, property):
+    """The property produced by ``CachedProperty``, which also knows how to invalidate everything that depends on it"""
+
+    def __init__(self, cached_property, storage, fget, fset=None, fdel=None, doc=None):
+        super().__init__(fget, fset, fdel, doc)
+        self.cached_property = cached_property
+        self.name = cached_property.name
+        self.affected_properties = cached_property.affected_properties
+        self.storage = storage
+        self.reset = storage.clear
+        self.plans = {}
+        self.incremental_plans = {}
+
+    @property
+    def updater(self):
+        # Kept on the CachedProperty, so that it's shared with any copies made by ``setter`` and friends
+        return self.cached_property.updater
+
+    def exported(self, value):
+        # Expiry times are only meaningful within this process
+        if not self.cached_property.serialize or self.cached_property.ttl is not None:
+            return _MISSING
+        # The collection's wrapper is bound to this instance, so only its contents are kept, and re-wrapped on restore
+        return value.collection if isinstance(value, CachedCollection) else value
+
+    def restore(self, inst):
+        if self.cached_property.is_collection:
+            value = self.storage.load(inst)
+            if value is not _MISSING and not isinstance(value, CachedCollection):
+                self.storage.store(inst, self.wrap_collection(inst, value))
+
+    def incremental(self, updater):
+        """Decorates a function that updates this property's value incrementally, instead of recomputing it from
+        scratch, when a collection it depends on is mutated in place. It's called as ``updater(self, previous,
+        mutations)``, where ``previous`` is the last value, and ``mutations`` is the list of ``Mutation`` records made
+        since, and it returns the new value.
+
+        If the collection is replaced or invalidated entirely (or the property isn't cached yet), the property is just
+        recomputed as usual.
+        """
+        self.cached_property.updater = updater
+        return self
+
+    def _rebuilt(self, fget, fset, fdel):
+        """A copy of this descriptor with different accessors (``property.getter`` and friends build the new property
+        by calling the class with just the accessors, which doesn't work for this class). The copy shares the original's
+        plans and closures, which keep their state on the ``CachedProperty``"""
+        rebuilt = type(self).__new__(type(self))
+        property.__init__(rebuilt, fget, fset, fdel, self.__doc__)
+        rebuilt.__dict__.update(self.__dict__)
+        return rebuilt
+
+    def _invalidating(self, func):
+        """Wraps a custom setter or deleter so that, after it runs, the cached value and everything computed from it
+        are dropped"""
+        @functools.wraps(func)
+        def invalidating(inner_self, *args):
+            func(inner_self, *args)
+            self.reset(inner_self)
+            self.reset_dependents(inner_self)
+
+        return invalidating
+
+    def getter(self, fget):
+        return self._rebuilt(fget, self.fset, self.fdel)
+
+    def setter(self, fset):
+        return self._rebuilt(self.fget, self._invalidating(fset), self.fdel)
+
+    def deleter(self, fdel):
+        return self._rebuilt(self.fget, self.fset, self._invalidating(fdel))
+
+
+def _cache_attribute_names(cls):
+    """The names of every instance attribute that cached values of this class might be stored in"""
+    names = {_COMPACT_ATTRIBUTE}
+    for klass in cls.__mro__:
+        for attr in vars(klass).values():
+            if isinstance(attr, _CacheNode) and isinstance(attr.storage, _AttributeStorage):
+                names.update((attr.storage.cache_name, attr.storage.flag_name, attr.storage.lock_name))
+    return names
+
+
+# Class -> property name -> the names of the settable or collection properties upstream of it
+_stateful_upstreams = weakref.WeakKeyDictionary()
+
+
+def _stateful_upstream_names(cls, name):
+    """The cached properties upstream of a property (i.e., that affect it, directly or not) whose values can change
+    without any of the instance's attributes changing: settable properties, and collections"""
+    try:
+        return _stateful_upstreams[cls][name]
+    except KeyError:
+        pass
+    nodes = _cache_nodes(cls)
+    upstream = {n: set() for n in nodes}
+    for n, node in nodes.items():
+        for affected in node.affected_properties:
+            upstream.setdefault(affected, set()).add(n)
+    found = set()
+    stack = list(upstream.get(name, ()))
+    while stack:
+        n = stack.pop()
+        if n not in found:
+            found.add(n)
+            stack.extend(upstream.get(n, ()))
+    stateful = []
+    for n in sorted(found):
+        prop = getattr(nodes.get(n), 'cached_property', None)
+        if n != name and prop is not None and (prop.settable or prop.is_collection):
+            stateful.append(n)
+    _stateful_upstreams.setdefault(cls, {})[name] = stateful
+    return stateful
+
+
+def _default_fingerprint(inst, name):
+    """Fingerprints an instance for one of its properties by pickling its attributes (except for its cached values),
+    along with the current values of the settable and collection properties upstream of that property"""
+    try:
+        state = vars(inst)
+    except TypeError:
+        raise TypeError("Can't automatically fingerprint {} instances (no __dict__); pass a fingerprint function to "
+                        "CachedProperty".format(type(inst).__name__))
+    cls = type(inst)
+    excluded = _cache_attribute_names(cls)
+    state = sorted((k, v) for k, v in state.items() if k not in excluded)
+    upstream = []
+    for n in _stateful_upstream_names(cls, name):
+        value = getattr(inst, n)
+        upstream.append((n, value.collection if isinstance(value, CachedCollection) else value))
+    return pickle.dumps((cls.__module__, cls.__qualname__, state, upstream), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class _DiskCache:
+    """Persists a cached property's values in a directory, keyed by the instance's fingerprint and a hash of the
+    property's source code. Arrays are saved as ``.npy`` files and memory-mapped back in when read; everything else
+    is pickled."""
+
+    def __init__(self, directory, f, fingerprint):
+        self.directory = directory
+        self.f = f
+        self.fingerprint = fingerprint or functools.partial(_default_fingerprint, name=f.__name__)
+        self._source_hash = None
+
+    @property
+    def source_hash(self):
+        if self._source_hash is None:
+            try:
+                source = inspect.getsource(self.f).encode()
+            except (OSError, TypeError):
+                source = self.f.__code__.co_code
+            self._source_hash = hashlib.sha1(source).hexdigest()
+        return self._source_hash
+
+    def _path(self, inst):
+        fingerprint = self.fingerprint(inst)
+        if isinstance(fingerprint, str):
+            fingerprint = fingerprint.encode()
+        key = hashlib.sha1(fingerprint + self.source_hash.encode()).hexdigest()
+        return os.path.join(self.directory, '{}.{}'.format(self.f.__module__, self.f.__qualname__), key)
+
+    def load_or_compute(self, inst):
+        path = self._path(inst)
+        try:
+            import numpy as np
+            if os.path.exists(path + '.npy'):
+                return np.load(path + '.npy', mmap_mode='r')
+        except ImportError:  # pragma: nocover
+            np = None
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(path + '.pkl', 'rb') as fd:
+                return pickle.load(fd)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+        value = self.f(inst)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so a concurrent reader never sees a partially written value
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                if np is not None and isinstance(value, np.ndarray) and not value.dtype.hasobject:
+                    np.save(out, value)
+                    ext = '.npy'
+                else:
+                    pickle.dump(value, out, protocol=pickle.HIGHEST_PROTOCOL)
+                    ext = '.pkl'
+            os.replace(tmp, path + ext)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return value
+
+
+class CacheStats:
+    """Usage statistics for a single cached property, collected while ``CachedProperty.collect_stats`` is enabled"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._clear()
+
+    def _clear(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._timed = 0
+        # id(instance) -> estimated size of that instance's cached value
+        self._sizes = {}
+
+    @property
+    def mean_time(self):
+        """The mean time taken to compute a value, in seconds"""
+        return self.total_time / self._timed if self._timed else 0.0
+
+    @property
+    def time_saved(self):
+        """The compute time avoided by cache hits, in seconds"""
+        return self.hits * self.mean_time
+
+    @property
+    def time_wasted(self):
+        """The compute time thrown away by invalidating cached values, in seconds"""
+        return self.invalidations * self.mean_time
+
+    @property
+    def memory(self):
+        """The estimated memory held by this property's currently cached values (on live instances), in bytes"""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self, inst, value, elapsed=None):
+        key = id(inst)
+        with self._lock:
+            self.misses += 1
+            if elapsed is not None:
+                self._timed += 1
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+            new = key not in self._sizes
+            self._sizes[key] = _estimate_size(value)
+        if new:
+            try:
+                weakref.finalize(inst, self._sizes.pop, key, None)
+            except TypeError:
+                pass
+
+    def record_invalidation(self, inst):
+        with self._lock:
+            self.invalidations += 1
+            self._sizes.pop(id(inst), None)
+
+    def reset(self):
+        """Clears all statistics collected so far"""
+        with self._lock:
+            self._clear()
+
+    def __repr__(self):
+        return ('<CacheStats hits={} misses={} invalidations={} mean={:0.6f}s max={:0.6f}s memory={}B>'
+                .format(self.hits, self.misses, self.invalidations, self.mean_time, self.max_time, self.memory))
+
+
+class _Ready:
+    """An awaitable that immediately produces an already-known value"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __await__(self):
+        return self.value
+        yield  # pragma: nocover
+
+
+class _Refresher:
+    """A single background thread that runs jobs (each taking an instance) at scheduled times: refreshing stale
+    values of ``stale_while_revalidate`` properties, and invalidating the dependents of values as they expire. Jobs
+    only hold weak references to their instances, and are dropped if the instance is garbage collected first."""
+
+    def __init__(self):
+        # (time, sequence number, reference to instance, job), soonest first
+        self.queue = []
+        self.count = 0
+        self.condition = Condition(Lock())
+        self.thread = Thread(target=self.run, name='CachedProperty refresher', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def get():
+        global _refresher
+        if _refresher is None:
+            with _creation_lock:
+                if _refresher is None:
+                    _refresher = _Refresher()
+        return _refresher
+
+    def schedule(self, when, inst, job):
+        try:
+            ref = weakref.ref(inst)
+        except TypeError:
+            ref = lambda: inst
+        with self.condition:
+            self.count += 1
+            heapq.heappush(self.queue, (when, self.count, ref, job))
+            if self.queue[0][1] == self.count:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > monotonic():
+                    self.condition.wait(self.queue[0][0] - monotonic() if self.queue else None)
+                _, _, ref, job = heapq.heappop(self.queue)
+            inst = ref()
+            if inst is not None:
+                try:
+                    job(inst)
+                except Exception as e:
+                    warnings.warn("Background cache job for {} failed: {!r}".format(type(inst).__name__, e))
+            del inst
+
 
 class CachedProperty:
     caches = []
 
-    def __init__(self, *affects, settable=False, threadsafe=True, is_collection=False, allow_collection_mutation=True):
+    @staticmethod
+    def set_memory_budget(max_bytes):
+        """Limits the total memory held by computed cached property values, across all instances of all classes. Once
+        the limit is exceeded, the least recently used values are dropped (without invalidating anything that depends
+        on them), and simply get recomputed on their next access. Sizes are estimated using ``nbytes`` (e.g., for
+        ``numpy`` arrays) or ``sys.getsizeof``.
+
+        Only computed values are subject to eviction: values that were assigned directly, or collections that have
+        been mutated, are kept. Instances that can't be weakly referenced aren't tracked.
+
+        :param max_bytes: The budget, in bytes, or ``None`` to remove the limit
+        """
+        global _memory_budget, _observing
+        if max_bytes is None:
+            _memory_budget = None
+        elif _memory_budget is None:
+            _memory_budget = _MemoryBudget(max_bytes)
+        else:
+            _memory_budget.resize(max_bytes)
+        _observing = _collect_stats or _memory_budget is not None
+
+    @staticmethod
+    def collect_stats(enabled=True):
+        """Turns usage statistics (hits, misses, invalidations, compute times, and memory held) on or off for all
+        cached properties. Each property's statistics are available as ``.stats`` on its entry in
+        ``CachedProperty.caches``, and ``CachedProperty.report()`` summarizes them.
+
+        :param enabled: Whether to collect statistics
+        """
+        global _collect_stats, _observing
+        _collect_stats = enabled
+        _observing = _collect_stats or _memory_budget is not None
+
+    @staticmethod
+    def report(sort_by='saved', top=None):
+        """Summarizes the usage statistics of all cached properties (see ``collect_stats``), one property per line,
+        ranked by how much compute time caching has saved (or wasted).
+
+        - Time saved is the number of hits times the mean compute time: the time it would have taken to compute those
+          values from scratch
+        - Time wasted is the number of invalidations times the mean compute time: the work thrown away, which has to
+          be redone on the next access
+
+        :param sort_by: Either 'saved' or 'wasted'
+        :param top: The number of properties to include (defaults to all that have been used)
+        :return: The report, as a string
+        """
+        key = {'saved': lambda c: c.stats.time_saved, 'wasted': lambda c: c.stats.time_wasted}[sort_by]
+        used = sorted((c for c in CachedProperty.caches if c.stats.hits or c.stats.misses), key=key, reverse=True)
+        lines = ['{:<50} {:>9} {:>9} {:>9} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+            'property', 'hits', 'misses', 'invalid', 'mean (s)', 'max (s)', 'saved (s)', 'wasted (s)', 'memory (B)')]
+        for c in used[:top]:
+            st = c.stats
+            lines.append('{:<50} {:>9} {:>9} {:>9} {:>10.6f} {:>10.6f} {:>10.4f} {:>10.4f} {:>12}'.format(
+                c.f.__qualname__, st.hits, st.misses, st.invalidations, st.mean_time, st.max_time, st.time_saved,
+                st.time_wasted, st.memory))
+        return '\n'.join(lines)
+
+    @staticmethod
+    @contextmanager
+    def batch(inst):
+        """Defers invalidating the dependents of an instance's cached values until the end of the block, then applies
+        each affected reset just once. This makes bulk updates (e.g., appending many items to a cached collection) as
+        cheap as a single update. Batches can be nested; invalidations are applied when the outermost one exits.
+
+        Note that, within the block, dependent values aren't invalidated yet, and might be stale if read.
+
+        :param inst: The instance whose invalidations should be deferred
+        """
+        key = id(inst)
+        with _batches_lock:
+            batch = _batches.setdefault(key, [0, OrderedDict()])
+            batch[0] += 1
+        try:
+            yield
+        finally:
+            with _batches_lock:
+                batch[0] -= 1
+                done = batch[0] == 0
+                if done:
+                    del _batches[key]
+            if done:
+                applied = set()
+                for node, mutations in batch[1].items():
+                    node.apply_invalidation(inst, mutations, applied)
+
+    def __init__(self, *affects, settable=False, threadsafe=True, is_collection=False, allow_collection_mutation=True,
+                 compact=False, persist=None, fingerprint=None, serialize=True, ttl=None, stale_while_revalidate=None):
         """Marks this property to be cached. Delete this property to remove the cached value and force it to be rerun.
 
         :param affects: Strings that list the names of the other properties in this class that are directly invalidated
@@ -94,12 +1149,44 @@ class CachedProperty:
         :param is_collection: Whether or not this property returns a collection (currently supports lists, sets, and
          dictionaries; others might not work exactly as expected)
         :param allow_collection_mutation: Whether or not the returned collection should allow its values to be altered
+        :param compact: Whether to store this value in the instance's single shared list of cached values, instead of
+         in its own ``_<name>``/``_need_<name>``/``_lock_<name>`` attributes. This saves memory on classes with many
+         instances, and works with ``__slots__`` classes that declare a ``_cached_values`` slot (or a ``__weakref__``
+         slot, in which case the values are kept in a side table)
+        :param persist: A directory in which to persist computed values across runs (or ``True`` to use
+         ``~/.cache/miniutils``). Values are keyed by the instance's fingerprint and a hash of this property's source
+         code. ``numpy`` arrays are saved as ``.npy`` files and memory-mapped (read-only) when loaded, while everything
+         else is pickled
+        :param fingerprint: A function that takes the instance and returns a string (or bytes) identifying everything
+         the property's value depends on. Defaults to pickling the instance's attributes (other than cached values),
+         along with the current values of any settable or collection properties that affect this one. A custom
+         fingerprint has to cover those itself
+        :param serialize: Whether to keep this property's cached value when the instance is pickled or copied (if not,
+         it's recomputed on the copy's first access). Locks are never kept
+        :param ttl: The number of seconds after which a computed value expires (``None`` to never expire). An expired
+         value is recomputed on its next access, and everything it affects is invalidated when it expires
+        :param stale_while_revalidate: The number of seconds (or ``True`` for no limit) after a value expires during
+         which it's still returned immediately, while a single background thread recomputes it. Past that, reading it
+         blocks until it's recomputed, as it does without this option
         """
         self.affected_properties = affects
         self.settable = settable
         self.threadsafe = threadsafe
         self.is_collection = is_collection
         self.allow_collection_mutation = allow_collection_mutation
+        self.compact = compact
+        if persist is True:
+            persist = os.path.join(os.path.expanduser('~'), '.cache', 'miniutils')
+        self.persist = persist
+        self.fingerprint = fingerprint
+        self.serialize = serialize
+        self.ttl = ttl
+        if stale_while_revalidate is True:
+            stale_while_revalidate = float('inf')
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stats = CacheStats()
+        # The function that updates the value incrementally (see _CachedPropertyDescriptor.incremental), if any
+        self.updater = None
         self.name = '???'
         self.f = None
         CachedProperty.caches.append(self)
@@ -107,65 +1194,465 @@ class CachedProperty:
     def __call__(self, f):
         self.f = f
         self.name = name = f.__name__
-        flag_name = '_need_' + name
-        cache_name = '_' + name
+        storage = _CompactStorage(name) if self.compact else _AttributeStorage(name)
+        is_async = inspect.iscoroutinefunction(f)
+        if is_async and self.persist:
+            raise TypeError("Async cached properties can't be persisted")
+        if self.stale_while_revalidate is not None:
+            if self.ttl is None:
+                raise ValueError("stale_while_revalidate requires a ttl")
+            if is_async:
+                raise TypeError("Async cached properties can't be revalidated in the background")
 
         def reset_dependents(inner_self):
-            for affected in self.affected_properties:
-                delattr(inner_self, affected)
+            descriptor.reset_dependents(inner_self)
+
+        def on_collection_update(inner_self, *mutation):
+            # A mutated collection can't be recomputed, so it's no longer safe to evict
+            if _memory_budget is not None:
+                _memory_budget.forget(inner_self, storage)
+            descriptor.reset_dependents(inner_self, Mutation(name, *mutation) if mutation else None)
+
+        def wrap_collection(inner_self, value):
+            return CachedCollection(value, on_collection_update, inner_self, self.allow_collection_mutation)
+
+        if self.persist:
+            disk_cache = _DiskCache(self.persist, f, self.fingerprint)
+
+            @functools.wraps(disk_cache.f)
+            def f(inner_self):
+                return disk_cache.load_or_compute(inner_self)
 
         if self.is_collection:
             orig_f = f
 
-            @functools.wraps(orig_f)
-            def f(inner_self):
-                return CachedCollection(orig_f(inner_self), reset_dependents, inner_self,
-                                        self.allow_collection_mutation)
+            if is_async:
+                @functools.wraps(orig_f)
+                async def f(inner_self):
+                    return wrap_collection(inner_self, await orig_f(inner_self))
+            else:
+                @functools.wraps(orig_f)
+                def f(inner_self):
+                    return wrap_collection(inner_self, orig_f(inner_self))
 
-        if self.threadsafe:
-            lock_name = '_lock_' + name
+        load = storage.load
+        stats = self.stats
+        # Previous values and mutation logs for incremental updates: id(instance) -> (previous value, mutations)
+        pending = {}
+
+        def produce(inner_self):
+            if pending:
+                entry = pending.pop(id(inner_self), None)
+                if entry is not None:
+                    previous, mutations = entry
+                    if not self.is_collection:
+                        return self.updater(inner_self, previous, mutations)
+                    return wrap_collection(inner_self, self.updater(inner_self, previous.collection, mutations))
+            return f(inner_self)
+
+        def log_mutation(inner_self, mutation):
+            key = id(inner_self)
+            entry = pending.get(key)
+            if entry is None:
+                previous = load(inner_self)
+                if previous is _MISSING:
+                    # Nothing to update, so it'll just be computed from scratch
+                    return
+                entry = pending[key] = (previous, [])
+                try:
+                    weakref.finalize(inner_self, pending.pop, key, None)
+                except TypeError:
+                    pass
+                # Make the next access miss, so it can apply the update
+                storage.clear(inner_self)
+            entry[1].append(mutation)
+
+        ttl = self.ttl
+        # When each instance's value expires (in monotonic time): id(instance) -> deadline
+        expires = {}
+
+        def set_expiry(inner_self, deadline):
+            key = id(inner_self)
+            if key not in expires:
+                try:
+                    weakref.finalize(inner_self, expires.pop, key, None)
+                except TypeError:
+                    pass
+            expires[key] = deadline
+
+        def expire_dependents(deadline):
+            def job(inner_self):
+                # Unless the value has been recomputed since
+                if expires.get(id(inner_self)) == deadline:
+                    reset_dependents(inner_self)
+            return job
+
+        def cache(inner_self, value, elapsed=None):
+            """Stores a newly computed value"""
+            if ttl is not None:
+                # Set before storing, so the new value is never mistaken for an expired one
+                deadline = monotonic() + ttl
+                set_expiry(inner_self, deadline)
+                if self.affected_properties:
+                    _Refresher.get().schedule(deadline, inner_self, expire_dependents(deadline))
+            storage.store(inner_self, value)
+            if _memory_budget is not None:
+                _memory_budget.track(inner_self, storage, value)
+            if _collect_stats:
+                stats.record_miss(inner_self, value, elapsed)
+
+        def on_hit(inner_self):
+            if _memory_budget is not None:
+                _memory_budget.touch(inner_self, storage)
+            if _collect_stats:
+                stats.record_hit()
+
+        def compute(inner_self):
+            if _collect_stats:
+                start = perf_counter()
+                value = produce(inner_self)
+                cache(inner_self, value, perf_counter() - start)
+            else:
+                value = produce(inner_self)
+                cache(inner_self, value)
+            return value
+
+        if is_async:
+            # The computations currently running, by id(instance), shared by every task that awaits them
+            in_flight = {}
+
+            async def compute_async(inner_self):
+                key = id(inner_self)
+                task = in_flight.get(key)
+                if task is None:
+                    start = perf_counter()
+                    task = in_flight[key] = asyncio.ensure_future(f(inner_self))
+
+                    def finish(done):
+                        # If the value was invalidated while it was being computed, the result is already stale
+                        if in_flight.get(key) is done:
+                            del in_flight[key]
+                            if not done.cancelled() and done.exception() is None:
+                                cache(inner_self, done.result(), perf_counter() - start)
+
+                    task.add_done_callback(finish)
+                # Shield the shared computation, so that cancelling one awaiter doesn't cancel it for all the others
+                return await asyncio.shield(task)
 
             @functools.wraps(f)
             def inner_getter(inner_self):
-                if not hasattr(inner_self, lock_name):
-                    setattr(inner_self, lock_name, RLock())
-                with getattr(inner_self, lock_name):
-                    if getattr(inner_self, flag_name, True):
-                        setattr(inner_self, cache_name, f(inner_self))
-                        setattr(inner_self, flag_name, False)
-                return getattr(inner_self, cache_name)
+                value = load(inner_self)
+                if value is _MISSING:
+                    return compute_async(inner_self)
+                if _observing:
+                    on_hit(inner_self)
+                return _Ready(value)
+
+        elif self.threadsafe:
+            @functools.wraps(f)
+            def inner_getter(inner_self):
+                # Cache hits never touch the lock; it's only needed to make sure a missing value is computed once
+                value = load(inner_self)
+                if value is _MISSING:
+                    with storage.lock(inner_self):
+                        value = load(inner_self)
+                        if value is _MISSING:
+                            return compute(inner_self)
+                if _observing:
+                    on_hit(inner_self)
+                return value
 
         else:
             @functools.wraps(f)
             def inner_getter(inner_self):
-                if getattr(inner_self, flag_name, True):
-                    setattr(inner_self, cache_name, f(inner_self))
-                    setattr(inner_self, flag_name, False)
-                return getattr(inner_self, cache_name)
+                value = load(inner_self)
+                if value is _MISSING:
+                    return compute(inner_self)
+                if _observing:
+                    on_hit(inner_self)
+                return value
+
+        if ttl is not None:
+            fresh_getter = inner_getter
+            stale_window = self.stale_while_revalidate
+            # Instances whose value is being refreshed in the background, by id
+            refreshing = set()
+
+            def refresh(inner_self):
+                # If this fails, the stale value is kept (until a read past the stale window recomputes it, and raises)
+                try:
+                    if self.threadsafe:
+                        with storage.lock(inner_self):
+                            compute(inner_self)
+                    else:
+                        compute(inner_self)
+                    reset_dependents(inner_self)
+                finally:
+                    refreshing.discard(id(inner_self))
+
+            def read_expired(inner_self, value):
+                if value is not _MISSING:
+                    key = id(inner_self)
+                    if stale_window is not None and monotonic() < expires.get(key, 0) + stale_window:
+                        if key not in refreshing:
+                            refreshing.add(key)
+                            _Refresher.get().schedule(0, inner_self, refresh)
+                        return value
+                    # Too stale to serve: drop it, along with everything computed from it
+                    if reset(inner_self):
+                        reset_dependents(inner_self)
+                return fresh_getter(inner_self)
+
+            @functools.wraps(f)
+            def inner_getter(inner_self):
+                value = load(inner_self)
+                if value is _MISSING or monotonic() >= expires.get(id(inner_self), 0):
+                    return read_expired(inner_self, value)
+                if _observing:
+                    on_hit(inner_self)
+                return value if not is_async else _Ready(value)
+
+        def reset(inner_self):
+            if is_async:
+                in_flight.pop(id(inner_self), None)
+            if pending:
+                pending.pop(id(inner_self), None)
+            if storage.clear(inner_self):
+                if _collect_stats:
+                    stats.record_invalidation(inner_self)
+                return True
+            return False
 
         def inner_deleter(inner_self):
-            assert getattr(inner_self, flag_name, True) or hasattr(inner_self, cache_name)
-            setattr(inner_self, flag_name, True)
-            if hasattr(inner_self, cache_name):
-                delattr(inner_self, cache_name)
-                # If we make this recursion conditional on the cache existing, we prevent dependency cycles from
-                # breaking the code
+            # Nothing downstream can have been computed from a value that wasn't cached
+            if reset(inner_self):
                 reset_dependents(inner_self)
 
         if not self.settable:
-            return property(fget=inner_getter, fdel=inner_deleter, doc=self.f.__doc__)
+            descriptor = _CachedPropertyDescriptor(self, storage, fget=inner_getter, fdel=inner_deleter,
+                                                   doc=self.f.__doc__)
         else:
-            # TODO: allow custom setter (preferably using the property.setter decorator)
             def inner_setter(inner_self, value):
                 if self.is_collection:
-                    setattr(inner_self, cache_name, CachedCollection(value, reset_dependents, inner_self,
-                                                                     self.allow_collection_mutation))
-                else:
-                    setattr(inner_self, cache_name, value)
-                setattr(inner_self, flag_name, False)
+                    value = wrap_collection(inner_self, value)
+                if is_async:
+                    # Don't let a computation that's still running overwrite the assigned value
+                    in_flight.pop(id(inner_self), None)
+                if ttl is not None:
+                    set_expiry(inner_self, float('inf'))
+                storage.store(inner_self, value)
+                # Assigned values can't be recomputed, so they're never evicted
+                if _memory_budget is not None:
+                    _memory_budget.forget(inner_self, storage)
                 reset_dependents(inner_self)
 
-            return property(fget=inner_getter, fset=inner_setter, fdel=inner_deleter, doc=self.f.__doc__)
+            descriptor = _CachedPropertyDescriptor(self, storage, fget=inner_getter, fset=inner_setter,
+                                                   fdel=inner_deleter, doc=self.f.__doc__)
+        descriptor.reset = reset
+
+        def store_computed(inner_self, value):
+            """Caches a value computed elsewhere (e.g., in another process), as if it were computed here"""
+            if self.is_collection:
+                value = wrap_collection(inner_self, value)
+            cache(inner_self, value)
+
+        descriptor.store_computed = store_computed
+        descriptor.log_mutation = log_mutation
+        descriptor.wrap_collection = wrap_collection
+        return descriptor
+
+
+def _compute_remotely(inst, name):
+    value = getattr(inst, name)
+    # The collection wrapper refers back to its instance, so just send its contents
+    return value.collection if isinstance(value, CachedCollection) else value
+
+
+def warm(inst, *names, executor=None, max_workers=None):
+    """Computes an instance's cached properties ahead of time, running independent properties in parallel. The
+    ``affects`` relationships declare what each property depends on, so every property is only started once all the
+    properties it depends on are cached (and properties they depend on are warmed too, even if not listed).
+
+    With a process pool, the instance is pickled and sent to the worker for each property, and the computed value is
+    stored back on the original instance.
+
+    :param inst: The instance whose properties should be computed
+    :param names: The names of the properties to compute (defaults to all of the instance's cached properties)
+    :param executor: A ``concurrent.futures`` executor (thread or process pool) to compute the properties in. Defaults
+     to a new thread pool
+    :param max_workers: The number of threads to use, if no executor is given
+    :return: The instance
+    """
+    cls = type(inst)
+    nodes = {name: node for name, node in _cache_nodes(cls).items()
+             if isinstance(node, _CachedPropertyDescriptor) and not inspect.iscoroutinefunction(node.cached_property.f)}
+    depends_on = {name: set() for name in nodes}
+    for name, node in nodes.items():
+        for affected in node.affected_properties:
+            if affected in depends_on:
+                depends_on[affected].add(name)
+
+    # Everything requested, and everything upstream of it
+    to_warm = set()
+    pending = list(names or nodes)
+    while pending:
+        name = pending.pop()
+        if name not in nodes:
+            raise AttributeError("{} has no cached property '{}' to warm".format(cls.__name__, name))
+        if name not in to_warm:
+            to_warm.add(name)
+            pending.extend(depends_on[name])
+    to_warm = {name for name in to_warm if nodes[name].storage.load(inst) is _MISSING}
+    waiting_on = {name: depends_on[name] & to_warm for name in to_warm}
+
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+    remote = isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+    try:
+        running = {}
+
+        def launch_ready():
+            for name in [name for name, deps in waiting_on.items() if not deps]:
+                del waiting_on[name]
+                if remote:
+                    running[executor.submit(_compute_remotely, inst, name)] = name
+                else:
+                    running[executor.submit(getattr, inst, name)] = name
+
+        launch_ready()
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                value = future.result()
+                if remote and nodes[name].storage.load(inst) is _MISSING:
+                    nodes[name].store_computed(inst, value)
+                for deps in waiting_on.values():
+                    deps.discard(name)
+            launch_ready()
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    # Anything left is stuck in a dependency cycle, which can only be computed serially
+    for name in waiting_on:
+        getattr(inst, name)
+    return inst
+
+
+# Separates positional from keyword arguments in default CachedMethod keys
+_KWARGS_MARK = object()
+
+
+def _default_method_key(*args, **kwargs):
+    if kwargs:
+        return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+    return args
+
+
+class _CachedMethodDescriptor(_CacheNode):
+    """The method produced by ``CachedMethod``. Each instance's results are kept in an ``OrderedDict`` (in least- to
+    most-recently used order), stored like any other cached value"""
+
+    def __init__(self, cached_method, storage, call):
+        self.cached_method = cached_method
+        self.name = cached_method.name
+        self.affected_properties = cached_method.affected_properties
+        self.storage = storage
+        self.reset = storage.clear
+        self.plans = {}
+        self.incremental_plans = {}
+        self.call = call
+        functools.update_wrapper(self, cached_method.f)
+
+    def exported(self, value):
+        # Expiry times are only meaningful within this process
+        return _MISSING if self.cached_method.ttl is not None else OrderedDict(value)
+
+    def __get__(self, inst, owner=None):
+        if inst is None:
+            return self
+        return types.MethodType(self.call, inst)
+
+    def __delete__(self, inst):
+        if self.storage.clear(inst):
+            self.reset_dependents(inst)
+
+
+class CachedMethod:
+    def __init__(self, *affects, maxsize=128, ttl=None, key=None, threadsafe=True, compact=False):
+        """Caches this method's return values per instance, keyed by its arguments. Delete the method from an instance
+        (``del obj.method``) to clear that instance's cache. It takes part in the same dependency chain as
+        ``CachedProperty``: list it in a cached property's ``affects`` to clear it whenever that property changes.
+
+        :param affects: Strings that list the names of the other properties in this class that are directly invalidated
+         when this method's cache is cleared
+        :param maxsize: The maximum number of results to keep per instance, evicting the least recently used first
+         (``None`` for no limit)
+        :param ttl: The number of seconds after which a cached result expires (``None`` to never expire)
+        :param key: A function that takes the method's arguments (not including ``self``) and returns the hashable key
+         to cache the result under. Defaults to the arguments themselves
+        :param threadsafe: Whether or not to restrict computing new results to a single thread at a time
+        :param compact: Whether to use compact storage (see ``CachedProperty``)
+        """
+        self.affected_properties = affects
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key or _default_method_key
+        self.threadsafe = threadsafe
+        self.compact = compact
+        self.name = '???'
+        self.f = None
+
+    def __call__(self, f):
+        self.f = f
+        self.name = name = f.__name__
+        storage = _CompactStorage(name) if self.compact else _AttributeStorage(name)
+        make_key = self.key
+        maxsize = self.maxsize
+        ttl = self.ttl
+
+        def lookup(cache, key):
+            try:
+                value = cache[key]
+                cache.move_to_end(key)
+            except KeyError:
+                return _MISSING
+            if ttl is not None:
+                value, expires = value
+                if monotonic() >= expires:
+                    return _MISSING
+            return value
+
+        def compute(inner_self, key, args, kwargs):
+            cache = storage.load(inner_self)
+            if cache is _MISSING:
+                cache = OrderedDict()
+                storage.store(inner_self, cache)
+            value = lookup(cache, key)
+            if value is _MISSING:
+                value = f(inner_self, *args, **kwargs)
+                cache[key] = value if ttl is None else (value, monotonic() + ttl)
+                if maxsize is not None:
+                    while len(cache) > maxsize:
+                        cache.popitem(last=False)
+            return value
+
+        @functools.wraps(f)
+        def call(inner_self, *args, **kwargs):
+            key = make_key(*args, **kwargs)
+            cache = storage.load(inner_self)
+            if cache is not _MISSING:
+                value = lookup(cache, key)
+                if value is not _MISSING:
+                    return value
+            if self.threadsafe:
+                with storage.lock(inner_self):
+                    return compute(inner_self, key, args, kwargs)
+            return compute(inner_self, key, args, kwargs)
+
+        return _CachedMethodDescriptor(self, storage, call)
 
 
 # def _get_class_that_defined_method(method):
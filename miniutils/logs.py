@@ -1,22 +1,130 @@
+import os
+
 from miniutils import logs_base
 
 
 logger = logs_base.logger
+# The listener thread and queue handler of asynchronous logging, if it's enabled
+_listener = None
+_queue_handler = None
 
 
-def enable_logging(log_level='NOTSET', *, logdir=None, use_colors=True, capture_warnings=True,
-                   format_str=r'%(asctime)s [%(launch_script)s | %(levelname)s]: %(message)s'):
-    global logger
+def _make_queue_handler(queue, when_full):
+    import logging.handlers
+    from queue import Full
+
+    class BoundedQueueHandler(logging.handlers.QueueHandler):
+        """Hands records to the listener thread, either waiting for room in the queue or dropping them if it's full"""
+
+        def __init__(self, queue):
+            super().__init__(queue)
+            self.dropped = 0
+
+        def prepare(self, record):
+            # Leave all formatting (of the message, its arguments, and any traceback) to the listener thread
+            return record
+
+        def enqueue(self, record):
+            if when_full == 'block':
+                self.queue.put(record)
+            else:
+                try:
+                    self.queue.put_nowait(record)
+                except Full:
+                    self.dropped += 1
+
+    return BoundedQueueHandler(queue)
+
+
+def _make_queue_listener(queue, handlers):
+    import logging.handlers
+
+    class QueueListener(logging.handlers.QueueListener):
+        def enqueue_sentinel(self):
+            # Wait for room, rather than failing to stop when the queue is full
+            self.queue.put(self._sentinel)
+
+    return QueueListener(queue, *handlers, respect_handler_level=True)
 
-    import os
+
+def _attach_handlers(listener, queue_handler):
+    """Attaches a listener's handlers directly to the logger again, in place of its queue handler"""
+    import logging
+
+    root = logging.getLogger()
+    if queue_handler in root.handlers:
+        root.removeHandler(queue_handler)
+        for handler in listener.handlers:
+            root.addHandler(handler)
+    return root
+
+
+def _stop_listener():
+    """Stops the listener thread once it's written out every queued record, and attaches its handlers directly to the
+    logger again (so anything logged afterwards, e.g., by other exit handlers, still gets written)"""
+    global _listener, _queue_handler
+
+    if _listener is None:
+        return
+    listener, queue_handler = _listener, _queue_handler
+    _listener = _queue_handler = None
+    listener.stop()
+    root = _attach_handlers(listener, queue_handler)
+    if queue_handler.dropped:
+        root.warning('%d log records were dropped because the logging queue was full', queue_handler.dropped)
+
+
+def _after_fork():
+    """A forked child doesn't inherit the listener thread, so it logs through the listener's handlers directly (records
+    queued before the fork are left to the parent)"""
+    global _listener, _queue_handler
+
+    if _listener is None:
+        return
+    listener, queue_handler = _listener, _queue_handler
+    _listener = _queue_handler = None
+    _attach_handlers(listener, queue_handler)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def enable_logging(log_level='NOTSET', *, logdir=None, use_colors=True, capture_warnings=True,
+                   format_str=r'%(asctime)s [%(launch_script)s | %(levelname)s]: %(message)s', async_handlers=False,
+                   queue_size=10000, when_full='block'):
+    """Sets up the root logger to log to stderr (in color, if ``coloredlogs`` is installed) and, optionally, to
+    rotating files in a directory
+
+    :param log_level: The name of the lowest level to log
+    :param logdir: A directory to write ``app.log`` files to
+    :param use_colors: Whether to color the stderr logs
+    :param capture_warnings: Whether to log warnings from the ``warnings`` module
+    :param format_str: The log record format
+    :param async_handlers: Whether to format and write records on a background thread, so that logging calls only
+     have to put records in a queue instead of waiting on terminal or disk I/O. Queued records are written out at exit.
+     Since messages are formatted later, on that thread, don't modify objects after passing them as logging arguments
+    :param queue_size: The most records the queue can hold, when using ``async_handlers``
+    :param when_full: What logging calls do when the queue is full: ``'block'`` until there's room, or ``'drop'`` the
+     record (the number of dropped records is logged at exit). Forked child processes log directly, without the queue
+    :return: The root logger
+    """
+    global logger, _listener, _queue_handler
+
+    import atexit
     import sys
     import logging.handlers
+    from queue import Queue
 
+    if when_full not in ('block', 'drop'):
+        raise ValueError("when_full must be 'block' or 'drop', not {!r}".format(when_full))
     if logdir is not None and not os.path.exists(logdir):
         os.makedirs(logdir)
+    _stop_listener()
+    logs_base.flush()
     logs_base.logger = logging.getLogger()
 
-    for handler in logs_base.logger.handlers:
+    for handler in list(logs_base.logger.handlers):
         logs_base.logger.removeHandler(handler)
 
     logs_base.logger.setLevel(getattr(logging, log_level))
@@ -69,25 +177,40 @@ def enable_logging(log_level='NOTSET', *, logdir=None, use_colors=True, capture_
     else:
         color_formatter = plain_formatter
 
+    handlers = []
     if logdir is not None:
         log_file_handler = logging.handlers.RotatingFileHandler(os.path.join(logdir, 'app.log'), maxBytes=2e20,
                                                                 backupCount=10)
         log_file_handler.name = 'log_file_handler'
         log_file_handler.setFormatter(plain_formatter)
         log_file_handler.setLevel(logging.NOTSET)
-        logs_base.logger.addHandler(log_file_handler)
+        handlers.append(log_file_handler)
 
     std_err_handler = logging.StreamHandler(sys.stderr)
     std_err_handler.name = 'stderr_colored_handler'
     std_err_handler.setFormatter(color_formatter)
     std_err_handler.setLevel(logging.NOTSET)
-    logs_base.logger.addHandler(std_err_handler)
+    handlers.append(std_err_handler)
+
+    if async_handlers:
+        queue = Queue(maxsize=queue_size)
+        _queue_handler = _make_queue_handler(queue, when_full)
+        _queue_handler.name = 'queue_handler'
+        logs_base.logger.addHandler(_queue_handler)
+        _listener = _make_queue_listener(queue, handlers)
+        _listener.start()
+        atexit.unregister(_stop_listener)
+        atexit.register(_stop_listener)
+    else:
+        for handler in handlers:
+            logs_base.logger.addHandler(handler)
 
     logger = logs_base.logger
     return logs_base.logger
 
 def disable_logging():
     global logger
+    _stop_listener()
     logs_base.logger = logger = None
 
 
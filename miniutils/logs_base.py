@@ -1,27 +1,113 @@
+import atexit
 import logging
+import os
 import sys
 from functools import partial
+from threading import Lock, Timer
 
 logger = None
 
+# Level numbers by name, so that logging calls don't have to look them up in the logging module every time
+_levels = dict(logging._nameToLevel)
 
-def proxy_log(msg, *args, **kwargs):
+
+def _level_number(log_level):
+    if not isinstance(log_level, str):
+        return log_level
+    try:
+        return _levels[log_level]
+    except KeyError:
+        # A level added with logging.addLevelName since this module was imported
+        lvl = _levels[log_level] = logging._nameToLevel[log_level]
+        return lvl
+
+
+class _StderrWriter:
+    """Writes fallback log messages to stderr. When stderr is a file or a pipe, messages below WARNING are written
+    without flushing stderr each time: a timer flushes it once the first unflushed message has waited ``max_delay``
+    seconds (and stderr flushes itself whenever its buffer fills up, anything else flushes it, or the program exits).
+    Since the messages go through stderr's own buffer, they stay in order with everything else written to it.
+    Messages to a terminal, or to a replaced ``sys.stderr``, are flushed right away"""
+
+    def __init__(self, max_delay=0.1):
+        self.max_delay = max_delay
+        self.timer = None
+        self.lock = Lock()
+        try:
+            self.batch = not sys.__stderr__.isatty()
+        except (AttributeError, ValueError):
+            self.batch = False
+
+    def write(self, line, lvl):
+        stream = sys.stderr
+        stream.write(line + '\n')
+        if stream is not sys.__stderr__:
+            stream.flush()
+        elif not self.batch or lvl >= logging.WARNING:
+            self.flush()
+        elif self.timer is None:
+            with self.lock:
+                if self.timer is None:
+                    self.timer = Timer(self.max_delay, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if sys.__stderr__ is not None:
+            sys.__stderr__.flush()
+
+
+_stderr = _StderrWriter()
+flush = _stderr.flush
+atexit.register(flush)
+if hasattr(os, 'register_at_fork'):
+    # Otherwise, both processes would write out the batched messages
+    os.register_at_fork(before=flush)
+
+
+def is_enabled_for(log_level):
+    """Whether messages at a level would be logged. Use this to skip building expensive log messages
+
+    :param log_level: The level's name or number
+    """
+    return logger is None or logger.isEnabledFor(_level_number(log_level))
+
+
+def proxy_log(msg, *args, log_level='INFO', **kwargs):
+    """Logs a message using the logger if there is one, or writes it to stderr otherwise. The message is only formatted
+    if it's going to be logged: it can be a ``%``-style format string (with ``args``), or a function that returns the
+    message
+
+    :param msg: The message, a format string, or a function that returns the message
+    :param args: The arguments to ``%``-format the message with
+    :param log_level: The level's name or number
+    :param kwargs: Other arguments for ``logger.log`` (e.g., ``exc_info``)
+    """
+    lvl = _level_number(log_level)
     if logger is None:
-        print(msg, file=sys.stderr, flush=True)
-    else:
-        lvl = kwargs.pop('log_level', 'INFO')
-        if isinstance(lvl, str):
-            lvl = logging._nameToLevel[lvl]
+        if callable(msg):
+            msg = msg()
+        msg = str(msg)
+        if args:
+            msg = msg % args
+        _stderr.write(msg, lvl)
+    elif logger.isEnabledFor(lvl):
+        if callable(msg):
+            msg = msg()
         logger.log(lvl, msg, *args, **kwargs)
 
 
-debug = partial(proxy_log, log_level='DEBUG')
-info = partial(proxy_log, log_level='INFO')
-warn = partial(proxy_log, log_level='WARNING')
-warning = partial(proxy_log, log_level='WARNING')
-error = partial(proxy_log, log_level='ERROR')
-critical = partial(proxy_log, log_level='CRITICAL')
-fatal = partial(proxy_log, log_level='FATAL')
+debug = partial(proxy_log, log_level=logging.DEBUG)
+info = partial(proxy_log, log_level=logging.INFO)
+warn = partial(proxy_log, log_level=logging.WARNING)
+warning = partial(proxy_log, log_level=logging.WARNING)
+error = partial(proxy_log, log_level=logging.ERROR)
+critical = partial(proxy_log, log_level=logging.CRITICAL)
+fatal = partial(proxy_log, log_level=logging.FATAL)
 
 
 def log(log_level, msg, *args, **kwargs):
@@ -7,7 +7,9 @@ def optional_argument_decorator(_decorator):
 
     @functools.wraps(_decorator)
     def inner_decorator_make(*args, **kwargs):
-        if len(args) == 1 and len(kwargs) == 0 and callable(args[0]):
+        # classmethod objects (and, before Python 3.10, staticmethod objects) aren't callable, but are still decorated
+        if len(args) == 1 and len(kwargs) == 0 and (callable(args[0]) or
+                                                     isinstance(args[0], (classmethod, staticmethod))):
             func = args[0]
             args = tuple()
             kwargs = dict()
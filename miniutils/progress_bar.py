@@ -80,43 +80,63 @@ def _parallel_progbar_launch(mapper, iterable, nprocs=None, starmap=False, flatm
         p.daemon = True
         p.start()
 
-    # Doing it this way prevents us from storing locally an entire list of the input values unnecessarily, and still
-    # gets us the number of elements sent for processing
-    sent = (q_in.put((i, x)) for i, x in enumerated_iterable)
-    num_sent = sum(1 for _ in sent)
-    for _ in range(nprocs):
-        # Send out a flag for each process to terminate once all elements are processed
-        q_in.put((None, None))
-
-    # Fetch the mapped results from the output queue, printing a progress bar as you go
-    if flatmap:
-        # If we're flat mapping, then we'll keep separate progress of all returned results (an unknown number) and how
-        # many inputs are complete (a known number). The outer loop will track the latter, and the inner loop the former
-        results = (q_out.get() for _ in progbar(itertools.count(),
-                                                verbose=verbose if verbose_flatmap is None else verbose_flatmap,
-                                                **kwargs))
-        for _ in progbar(num_sent, verbose=verbose):
-            for i, x in results:
-                # When we're flagged that an input is done being returned in the queue, break the inner loop to make
-                # the "completed inputs" progress bar tick
+    finished = False
+    try:
+        # Doing it this way prevents us from storing locally an entire list of the input values unnecessarily, and
+        # still gets us the number of elements sent for processing
+        sent = (q_in.put((i, x)) for i, x in enumerated_iterable)
+        num_sent = sum(1 for _ in sent)
+        for _ in range(nprocs):
+            # Send out a flag for each process to terminate once all elements are processed
+            q_in.put((None, None))
+
+        # Fetch the mapped results from the output queue, printing a progress bar as you go
+        if flatmap:
+            # If we're flat mapping, then we'll keep separate progress of all returned results (an unknown number) and
+            # how many inputs are complete (a known number). The outer loop will track the latter, and the inner loop
+            # the former
+            results = (q_out.get() for _ in progbar(itertools.count(),
+                                                    verbose=verbose if verbose_flatmap is None else verbose_flatmap,
+                                                    **kwargs))
+            for _ in progbar(num_sent, verbose=verbose):
+                for i, x in results:
+                    # When we're flagged that an input is done being returned in the queue, break the inner loop to
+                    # make the "completed inputs" progress bar tick
+                    if i is None:
+                        if x is None:
+                            break
+                        else:
+                            raise x
+                    yield i, x
+        else:
+            for i, x in (q_out.get() for _ in progbar(num_sent, verbose=verbose, **kwargs)):
                 if i is None:
-                    if x is None:
-                        break
-                    else:
-                        raise x
+                    raise x
                 yield i, x
-    else:
-        for i, x in (q_out.get() for _ in progbar(num_sent, verbose=verbose, **kwargs)):
-            if i is None:
-                raise x
-            yield i, x
+        finished = True
+    finally:
+        if finished:
+            # Clean up
+            for p in procs:
+                try:
+                    p.join(1)
+                except (TimeoutError, mp.TimeoutError, TimedOutException):
+                    warnings.warn("parallel_progbar mapping process failed to close properly (check error output)")
+        else:
+            # The consumer stopped early (closed the generator, broke out of a loop, or hit an error), so any work
+            # still queued up is wasted. Stop the workers immediately rather than letting them drain the input.
+            _cancel_workers(procs, q_in, q_out)
+
 
-    # Clean up
+def _cancel_workers(procs, q_in, q_out):
+    for p in procs:
+        p.terminate()
     for p in procs:
-        try:
-            p.join(1)
-        except (TimeoutError, mp.TimeoutError, TimedOutException):
-            warnings.warn("parallel_progbar mapping process failed to close properly (check error output)")
+        p.join()
+    for q in (q_in, q_out):
+        # Don't block interpreter exit waiting to flush inputs that nobody will ever read
+        q.cancel_join_thread()
+        q.close()
 
 
 def parallel_progbar(mapper, iterable, nprocs=None, starmap=False, flatmap=False, shuffle=False,
@@ -163,6 +183,98 @@ def iparallel_progbar(mapper, iterable, nprocs=None, starmap=False, flatmap=Fals
 
     results = _parallel_progbar_launch(mapper, iterable, nprocs, starmap, flatmap, shuffle, verbose,
                                        verbose_flatmap, max_cache, **kwargs)
-    return (x for i, x in results)
+    return _drop_indices(results)
+
+
+def _drop_indices(results):
+    try:
+        for i, x in results:
+            yield x
+    finally:
+        # Closing this generator (explicitly, or by discarding it) cancels any work still outstanding
+        results.close()
+
+
+def parallel_first(pred, mapper, iterable, default=None, nprocs=None, starmap=False, shuffle=False, verbose=True,
+                   **kwargs):
+    """Finds the first mapped value that satisfies a predicate, mapping the iterable in parallel. Equivalent to a
+    parallel version of ``next((y for y in map(mapper, iterable) if pred(y)), default)``, except that the remaining
+    work is cancelled as soon as the answer is known.
+
+    :param pred: The predicate to check each mapped value against
+    :param mapper: The mapping function to apply to elements of the iterable
+    :param iterable: The iterable to map
+    :param default: The value to return if no mapped value satisfies the predicate
+    :param nprocs: The number of processes (defaults to the number of cpu's)
+    :param starmap: If true, the iterable is expected to contain tuples and the mapper function gets each element of a
+        tuple as an argument
+    :param shuffle: If true, randomly sort the elements before processing them. The result is still the first match
+        in the original order.
+    :param verbose: Whether or not to print the progress bar
+    :param kwargs: Any other keyword arguments to pass to the progress bar (see ``progbar``)
+    :return: The first mapped value (in the order of the iterable) that satisfies ``pred``, or ``default``
+    """
+    results = _parallel_progbar_launch(mapper, iterable, nprocs, starmap, False, shuffle, verbose, **kwargs)
+    try:
+        best_i, best_x = None, default
+        # Indices that have finished without matching, and the lowest index not yet known to have finished
+        done = set()
+        lowest_pending = 0
+        for i, x in results:
+            if best_i is not None and i > best_i:
+                continue
+            if pred(x):
+                best_i, best_x = i, x
+            else:
+                done.add(i)
+            while lowest_pending in done:
+                done.remove(lowest_pending)
+                lowest_pending += 1
+            # Once everything before the best match is known not to match, nothing can beat it
+            if best_i is not None and lowest_pending >= best_i:
+                break
+        return best_x
+    finally:
+        results.close()
+
+
+def parallel_any(mapper, iterable, nprocs=None, starmap=False, shuffle=False, verbose=True, **kwargs):
+    """A parallel version of ``any(map(mapper, iterable))`` that stops all work as soon as a truthy value is found
+
+    :param mapper: The mapping function to apply to elements of the iterable
+    :param iterable: The iterable to map
+    :param nprocs: The number of processes (defaults to the number of cpu's)
+    :param starmap: If true, the iterable is expected to contain tuples and the mapper function gets each element of a
+        tuple as an argument
+    :param shuffle: If true, randomly sort the elements before processing them
+    :param verbose: Whether or not to print the progress bar
+    :param kwargs: Any other keyword arguments to pass to the progress bar (see ``progbar``)
+    :return: Whether any mapped value was truthy
+    """
+    results = _parallel_progbar_launch(mapper, iterable, nprocs, starmap, False, shuffle, verbose, **kwargs)
+    try:
+        return any(x for i, x in results)
+    finally:
+        results.close()
+
+
+def parallel_all(mapper, iterable, nprocs=None, starmap=False, shuffle=False, verbose=True, **kwargs):
+    """A parallel version of ``all(map(mapper, iterable))`` that stops all work as soon as a falsy value is found
+
+    :param mapper: The mapping function to apply to elements of the iterable
+    :param iterable: The iterable to map
+    :param nprocs: The number of processes (defaults to the number of cpu's)
+    :param starmap: If true, the iterable is expected to contain tuples and the mapper function gets each element of a
+        tuple as an argument
+    :param shuffle: If true, randomly sort the elements before processing them
+    :param verbose: Whether or not to print the progress bar
+    :param kwargs: Any other keyword arguments to pass to the progress bar (see ``progbar``)
+    :return: Whether all mapped values were truthy
+    """
+    results = _parallel_progbar_launch(mapper, iterable, nprocs, starmap, False, shuffle, verbose, **kwargs)
+    try:
+        return all(x for i, x in results)
+    finally:
+        results.close()
 
 
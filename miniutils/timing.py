@@ -1,32 +1,586 @@
-import traceback
-from functools import partial
-from time import time
+import atexit
+from collections import defaultdict, deque
+import functools
+import gc
+import glob
+import inspect
+import itertools
+import json
+import linecache
+import multiprocessing.util
+import os
+import pickle
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+from threading import Event, Lock, Thread, get_ident, local
+from time import perf_counter, perf_counter_ns, process_time_ns, thread_time_ns, time
+import tracemalloc
+import types
 
-from miniutils.logs_base import log
+from miniutils.logs_base import is_enabled_for, log
+from miniutils.opt_decorator import optional_argument_decorator
 
+# Whether timing is enabled. When it's disabled (either here, or by setting the MINIUTILS_TIMING environment variable to
+# 0/false/off before this module is imported), the timing decorators return functions untouched
+enabled = os.environ.get('MINIUTILS_TIMING', '1').strip().lower() not in ('0', 'false', 'off', 'no')
 
-def timed_call(func, *args, log_level='DEBUG', **kwargs):
+
+def set_enabled(enable=True):
+    """Turns timing on or off. This only affects functions decorated afterwards: functions decorated while timing is
+    disabled are left untouched, so they never pay any overhead
+
+    :param enable: Whether timing should be enabled
+    """
+    global enabled
+    enabled = enable
+
+
+# Probes measure more than wall time over a timed call or block. Each is a pair of functions: one that takes a snapshot
+# when the call starts, and one that takes that snapshot at the end and returns a dictionary of measurements.
+def _start_tracemalloc():
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    # Before Python 3.9, the peak can't be reset, so it may include allocations made before the call
+    return started, tracemalloc.get_traced_memory()[0]
+
+
+def _stop_tracemalloc(token):
+    started, before = token
+    current, peak = tracemalloc.get_traced_memory()
+    if started:
+        tracemalloc.stop()
+    return {'alloc_net': current - before, 'alloc_peak': peak - before}
+
+
+# Totals of every garbage collection seen by _gc_callback: [collections, pause ns, start of the current collection]
+_gc_totals = [0, 0, None]
+
+
+def _gc_callback(phase, info):
+    if phase == 'start':
+        _gc_totals[2] = perf_counter_ns()
+    elif _gc_totals[2] is not None:
+        _gc_totals[0] += 1
+        _gc_totals[1] += perf_counter_ns() - _gc_totals[2]
+        _gc_totals[2] = None
+
+
+def _start_gc():
+    if _gc_callback not in gc.callbacks:
+        gc.callbacks.append(_gc_callback)
+    return _gc_totals[:2]
+
+
+def _stop_gc(token):
+    return {'gc': _gc_totals[0] - token[0], 'gc_pause': (_gc_totals[1] - token[1]) / 1e9}
+
+
+def _rss():
+    """The process's current resident set size, in bytes (0 where that isn't available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+_PROBES = {
+    'cpu': (process_time_ns, lambda start: {'cpu': (process_time_ns() - start) / 1e9}),
+    'thread_cpu': (thread_time_ns, lambda start: {'thread_cpu': (thread_time_ns() - start) / 1e9}),
+    'alloc': (_start_tracemalloc, _stop_tracemalloc),
+    'gc': (_start_gc, _stop_gc),
+    'rss': (_rss, lambda start: {'rss': _rss() - start}),
+}
+
+
+def _probe_names(probes):
+    """Normalizes a ``probes`` argument into a tuple of probe names"""
+    if not probes:
+        return ()
+    if probes is True:
+        return tuple(_PROBES)
+    if isinstance(probes, str):
+        probes = (probes,)
+    probes = tuple(probes)
+    for name in probes:
+        if name not in _PROBES:
+            raise ValueError("Unknown timing probe '{}' (expected one of: {})".format(name, ', '.join(_PROBES)))
+    return probes
+
+
+def _start_probes(names):
+    return [_PROBES[name][0]() for name in names]
+
+
+def _stop_probes(names, tokens):
+    # Stop in the reverse order, so the cheap probes don't measure the expensive ones
+    measured = [_PROBES[name][1](token) for name, token in reversed(list(zip(names, tokens)))]
+    results = {}
+    for measurements in reversed(measured):
+        results.update(measurements)
+    return results
+
+
+def _format_probe(name, value):
+    if name in ('cpu', 'thread_cpu', 'gc_pause'):
+        return '{:0.6f}s'.format(value)
+    if name.startswith(('alloc', 'rss')):
+        return '{:+0.0f}B'.format(value)
+    return '{:g}'.format(value)
+
+
+def _format_probes(results):
+    return ' '.join('{}={}'.format(name, _format_probe(name, value)) for name, value in results.items())
+
+
+# Durations are binned with 2**_SUB_BUCKET_BITS buckets per power of two (exactly, below 2**(_SUB_BUCKET_BITS + 1)
+# nanoseconds), so percentiles are within about 3% of the true value, and a histogram never has more than ~2000 bins
+_SUB_BUCKET_BITS = 5
+
+
+def _bucket(ns):
+    shift = ns.bit_length() - _SUB_BUCKET_BITS - 1
+    if shift <= 0:
+        return ns
+    return (shift << _SUB_BUCKET_BITS) + (ns >> shift)
+
+
+def _bucket_bounds(index):
+    """The range of durations (in nanoseconds) in a bucket, as [low, high)"""
+    shift = (index >> _SUB_BUCKET_BITS) - 1
+    if shift <= 0:
+        return index, index + 1
+    top = index - (shift << _SUB_BUCKET_BITS)
+    return top << shift, (top + 1) << shift
+
+
+class TimingStats:
+    """A streaming summary of a function's call durations: exact count, mean and max, and a log-scale histogram that
+    gives percentiles to within about 3% in bounded memory"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = {}
+        # Probe measurement name -> [total, max]
+        self.probes = {}
+        self._lock = Lock()
+
+    def record(self, ns):
+        """Adds a single call's duration, in nanoseconds"""
+        index = _bucket(ns)
+        with self._lock:
+            self.count += 1
+            self.total_ns += ns
+            if ns > self.max_ns:
+                self.max_ns = ns
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def record_probes(self, results):
+        """Adds a single call's probe measurements (see ``make_timed``'s ``probes``)"""
+        with self._lock:
+            for name, value in results.items():
+                totals = self.probes.get(name)
+                if totals is None:
+                    self.probes[name] = [value, value]
+                else:
+                    totals[0] += value
+                    totals[1] = max(totals[1], value)
+
+    @property
+    def total(self):
+        """The total time spent in the function, in seconds"""
+        return self.total_ns / 1e9
+
+    @property
+    def mean(self):
+        """The mean call duration, in seconds"""
+        return self.total_ns / self.count / 1e9 if self.count else 0.0
+
+    @property
+    def max(self):
+        """The longest call duration, in seconds"""
+        return self.max_ns / 1e9
+
+    def percentile(self, q):
+        """Estimates a percentile of the call durations
+
+        :param q: The percentile, from 0 to 100
+        :return: The estimated duration, in seconds
+        """
+        with self._lock:
+            buckets = sorted(self.buckets.items())
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q / 100 * count
+        seen = 0
+        for index, n in buckets:
+            seen += n
+            if seen >= rank:
+                low, high = _bucket_bounds(index)
+                return min((low + high - 1) / 2, self.max_ns) / 1e9
+        return self.max
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p95(self):
+        return self.percentile(95)
+
+    @property
+    def p99(self):
+        return self.percentile(99)
+
+    def summary(self):
+        """The statistics as a dictionary (durations in seconds)"""
+        summary = {'count': self.count, 'total': self.total, 'mean': self.mean, 'p50': self.p50, 'p95': self.p95,
+                   'p99': self.p99, 'max': self.max}
+        if self.probes:
+            summary['probes'] = {name: {'total': total, 'mean': total / self.count if self.count else 0, 'max': peak}
+                                 for name, (total, peak) in self.probes.items()}
+        return summary
+
+    def reset(self):
+        """Clears all durations recorded so far"""
+        with self._lock:
+            self.count = 0
+            self.total_ns = 0
+            self.max_ns = 0
+            self.buckets = {}
+            self.probes = {}
+
+    def __repr__(self):
+        return '<TimingStats {} count={} mean={:0.6f}s p50={:0.6f}s p99={:0.6f}s max={:0.6f}s>'.format(
+            self.name, self.count, self.mean, self.p50, self.p99, self.max)
+
+
+# The statistics of every function timed with make_timed(aggregate=True), by qualified name
+timing_stats = {}
+_report_at_exit = None
+
+
+def timed_call(func, *args, log_level='DEBUG', probes=None, **kwargs):
     """Logs a function's run time
 
     :param func: The function to run
     :param args: The args to pass to the function
     :param kwargs: The keyword args to pass to the function
     :param log_level: The log level at which to print the run time
+    :param probes: Other measurements to take over the call, and log along with its run time: any of 'cpu' (process
+     CPU time), 'thread_cpu' (this thread's CPU time), 'alloc' (``tracemalloc`` net and peak allocation, starting
+     ``tracemalloc`` for the call if it isn't already running), 'gc' (garbage collections, and the time they paused
+     for), and 'rss' (change in resident memory, on Linux). Pass True for all of them
     :return: The function's return value
     """
+    if not enabled:
+        return func(*args, **kwargs)
+    names = _probe_names(probes)
+    tokens = _start_probes(names)
     start = time()
-    r = func(*args, **kwargs)
-    t = time() - start
-    log(log_level, "Call to '{}' took {:0.6f}s".format(func.__name__, t))
+    try:
+        r = func(*args, **kwargs)
+    finally:
+        # Always stop the probes (e.g., so that tracemalloc isn't left running if the call raises)
+        t = time() - start
+        results = _stop_probes(names, tokens) if names else None
+    if is_enabled_for(log_level):
+        message = "Call to '{}' took {:0.6f}s".format(func.__name__, t)
+        if names:
+            message += ' [{}]'.format(_format_probes(results))
+        log(log_level, message)
     return r
 
 
-def make_timed(func):
-    """A decorator to make a function print its execution time whenever it gets called"""
-    return partial(timed_call, func)
+@optional_argument_decorator
+def make_timed(aggregate=False, sample=1, log_level='DEBUG', probes=None):
+    """A decorator to make a function print its execution time whenever it gets called. It works on plain functions,
+    and on instance, class, and static methods (apply it above ``@classmethod`` or ``@staticmethod``). The timed
+    function keeps its name and docstring, and the original is available as ``__wrapped__``.
+
+    If timing is disabled (see ``set_enabled``), the function is returned untouched.
+
+    :param aggregate: If True, don't log each call; instead, record its duration (using ``perf_counter_ns``) in the
+     function's ``TimingStats`` (see ``report`` and ``dump``). This is cheap enough for hot loops
+    :param sample: Only time one in every ``sample`` calls (the rest run untimed), to cut the overhead on very hot
+     functions. Aggregated statistics then only count the sampled calls
+    :param log_level: The log level at which to print each call's run time (when not aggregating)
+    :param probes: Other measurements to take over each call (see ``timed_call``). They're logged with the run time,
+     or added to the function's ``TimingStats.probes`` when aggregating. Not supported for coroutines or generators
+
+    Coroutine functions, generators, and async generators are timed from when they start running until they finish
+    (or are closed), rather than until the call returns. Along with that total, they report the time spent running
+    versus suspended (awaiting, or waiting for the consumer to ask for the next item), and generators also report the
+    time to their first item and the latency of each item. When aggregating, these are kept as separate
+    ``TimingStats`` (named after the function, plus ``[running]``, ``[suspended]``, ``[first item]``, or
+    ``[per item]``), available as the timed function's ``timing_breakdown``.
+    """
+    def decorator(func):
+        if not enabled:
+            return func
+        if isinstance(func, (classmethod, staticmethod)):
+            return type(func)(decorator(func.__func__))
+        names = _probe_names(probes)
+        if inspect.isasyncgenfunction(func) or inspect.iscoroutinefunction(func) or inspect.isgeneratorfunction(func):
+            if names:
+                raise ValueError("Timing probes aren't supported for coroutines or generators")
+            return _make_timed_resumable(func, aggregate, sample, log_level)
+
+        if aggregate:
+            name = '{}.{}'.format(func.__module__, func.__qualname__)
+            stats = timing_stats.setdefault(name, TimingStats(name))
+            record = stats.record
+
+            if names:
+                def measure(*args, **kwargs):
+                    tokens = _start_probes(names)
+                    start = perf_counter_ns()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        record(perf_counter_ns() - start)
+                        stats.record_probes(_stop_probes(names, tokens))
+            else:
+                def measure(*args, **kwargs):
+                    start = perf_counter_ns()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        record(perf_counter_ns() - start)
+        elif names:
+            stats = None
+
+            def measure(*args, **kwargs):
+                return timed_call(func, *args, log_level=log_level, probes=names, **kwargs)
+        else:
+            stats = None
+
+            def measure(*args, **kwargs):
+                start = perf_counter()
+                r = func(*args, **kwargs)
+                log(log_level, "Call to '%s' took %0.6fs", func.__name__, perf_counter() - start)
+                return r
+
+        if sample > 1:
+            # itertools.count is atomic, so sampling stays even across threads
+            calls = itertools.count()
+
+            def timed(*args, **kwargs):
+                if next(calls) % sample:
+                    return func(*args, **kwargs)
+                return measure(*args, **kwargs)
+        else:
+            timed = measure
+
+        timed = functools.wraps(func)(timed)
+        timed.timing_stats = stats
+        return timed
+
+    return decorator
+
+
+def _drive(inner, report):
+    """Runs a generator (or a coroutine's awaitable) to completion, passing along everything sent or thrown into it,
+    and timing each step it runs for. When it finishes (or is closed), calls ``report(total, running, items)`` with the
+    total and running times and the list of each yielded item's step time, all in nanoseconds"""
+    start = perf_counter_ns()
+    running = 0
+    items = []
+    value = error = None
+    try:
+        while True:
+            step = perf_counter_ns()
+            try:
+                yielded = inner.send(value) if error is None else inner.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                elapsed = perf_counter_ns() - step
+                running += elapsed
+            items.append(elapsed)
+            error = None
+            try:
+                value = yield yielded
+            except GeneratorExit:
+                inner.close()
+                raise
+            except BaseException as e:
+                error = e
+    finally:
+        report(perf_counter_ns() - start, running, items)
+
+
+@types.coroutine
+def _await_timed(awaitable, report):
+    return (yield from _drive(awaitable, report))
+
+
+def _make_timed_resumable(func, aggregate, sample, log_level):
+    """Builds ``make_timed``'s wrapper for a coroutine function, generator, or async generator"""
+    is_coroutine = inspect.iscoroutinefunction(func)
+
+    if aggregate:
+        name = '{}.{}'.format(func.__module__, func.__qualname__)
+        parts = ['running', 'suspended'] + ([] if is_coroutine else ['first item', 'per item'])
+        stats = timing_stats.setdefault(name, TimingStats(name))
+        breakdown = {part: timing_stats.setdefault('{} [{}]'.format(name, part),
+                                                   TimingStats('{} [{}]'.format(name, part)))
+                     for part in parts}
+
+        def report(total, running, items):
+            stats.record(total)
+            breakdown['running'].record(running)
+            breakdown['suspended'].record(total - running)
+            if not is_coroutine:
+                if items:
+                    breakdown['first item'].record(items[0])
+                for item in items:
+                    breakdown['per item'].record(item)
+    else:
+        stats = breakdown = None
+
+        def report(total, running, items):
+            if not is_enabled_for(log_level):
+                return
+            message = "Call to '{}' took {:0.6f}s ({:0.6f}s running, {:0.6f}s suspended".format(
+                func.__name__, total / 1e9, running / 1e9, (total - running) / 1e9)
+            if not is_coroutine:
+                message += ", {} items".format(len(items))
+                if items:
+                    message += ", first after {:0.6f}s".format(items[0] / 1e9)
+            log(log_level, message + ")")
+
+    if sample > 1:
+        calls = itertools.count()
+
+        def sampled():
+            return not next(calls) % sample
+    else:
+        def sampled():
+            return True
+
+    if is_coroutine:
+        async def timed(*args, **kwargs):
+            if sampled():
+                # Each step of the coroutine runs between two suspensions
+                return await _await_timed(func(*args, **kwargs), lambda total, running, _: report(total, running, ()))
+            return await func(*args, **kwargs)
+
+    elif inspect.isgeneratorfunction(func):
+        def timed(*args, **kwargs):
+            if sampled():
+                return (yield from _drive(func(*args, **kwargs), report))
+            return (yield from func(*args, **kwargs))
+
+    else:
+        async def timed(*args, **kwargs):
+            agen = func(*args, **kwargs)
+            timing = sampled()
+            start = perf_counter_ns()
+            # The running time of each step (an item can take several steps, if it awaits along the way)
+            running = []
+            items = []
+            value = error = None
+            try:
+                while True:
+                    step = perf_counter_ns()
+                    awaitable = agen.asend(value) if error is None else agen.athrow(error)
+                    try:
+                        if timing:
+                            item = await _await_timed(awaitable, lambda total, run, _: running.append(run))
+                        else:
+                            item = await awaitable
+                    except StopAsyncIteration:
+                        return
+                    items.append(perf_counter_ns() - step)
+                    error = None
+                    try:
+                        value = yield item
+                    except GeneratorExit:
+                        await agen.aclose()
+                        raise
+                    except BaseException as e:
+                        error = e
+            finally:
+                if timing:
+                    report(perf_counter_ns() - start, sum(running), items)
+
+    timed = functools.wraps(func)(timed)
+    timed.timing_stats = stats
+    timed.timing_breakdown = breakdown
+    return timed
+
+
+def report(sort_by='total', top=None):
+    """Summarizes the durations recorded by every ``make_timed(aggregate=True)`` function, one function per line
+
+    :param sort_by: The statistic to rank functions by: 'total', 'count', 'mean', 'p50', 'p95', 'p99', or 'max'
+    :param top: The number of functions to include (defaults to all that have been called)
+    :return: The report, as a string
+    """
+    used = sorted((st for st in timing_stats.values() if st.count), key=lambda st: getattr(st, sort_by),
+                  reverse=True)
+    lines = ['{:<50} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'function', 'calls', 'total (s)', 'mean (s)', 'p50 (s)', 'p95 (s)', 'p99 (s)', 'max (s)')]
+    for st in used[:top]:
+        lines.append('{:<50} {:>9} {:>10.4f} {:>10.6f} {:>10.6f} {:>10.6f} {:>10.6f} {:>10.6f}'.format(
+            st.name, st.count, st.total, st.mean, st.p50, st.p95, st.p99, st.max))
+        for name, (total, peak) in sorted(st.probes.items()):
+            lines.append('    {:<46} mean={} max={}'.format(
+                name, _format_probe(name, total / st.count), _format_probe(name, peak)))
+    return '\n'.join(lines)
+
+
+def dump(file=None):
+    """Exports the statistics of every ``make_timed(aggregate=True)`` function that's been called, as JSON
+
+    :param file: A path or writable file object to write the JSON to (if None, nothing is written)
+    :return: The statistics, as a dictionary of function name to its summary
+    """
+    data = {name: st.summary() for name, st in timing_stats.items() if st.count}
+    if isinstance(file, str):
+        with open(file, 'w') as f:
+            json.dump(data, f, indent=2)
+    elif file is not None:
+        json.dump(data, file, indent=2)
+    return data
+
+
+def reset_stats():
+    """Clears the statistics of every ``make_timed(aggregate=True)`` function"""
+    for st in timing_stats.values():
+        st.reset()
+
+
+def report_at_exit(log_level='INFO', enabled=True):
+    """Logs the aggregated timing ``report`` when the interpreter exits
+
+    :param log_level: The level at which to log the report
+    :param enabled: Whether to log it (pass False to cancel a previous call)
+    """
+    global _report_at_exit
+    if _report_at_exit is None:
+        atexit.register(_log_report_at_exit)
+    _report_at_exit = log_level if enabled else False
+
 
+def _log_report_at_exit():
+    if _report_at_exit and any(st.count for st in timing_stats.values()):
+        log(_report_at_exit, 'Timing summary:\n' + report())
 
-def tic(log_level='DEBUG', fmt="{file}:{line} - {message} - {diff:0.6f}s (total={total:0.1f}s)", verbose=True):
+
+def tic(log_level='DEBUG', fmt="{file}:{line} - {message} - {diff:0.6f}s (total={total:0.1f}s)", verbose=True,
+        probes=None):
     """A minimalistic ``printf``-type timing utility. Call this function to start timing individual sections of code
 
     :param log_level: The level at which to log block run times
@@ -36,9 +590,22 @@ def tic(log_level='DEBUG', fmt="{file}:{line} - {message} - {diff:0.6f}s (total=
                 - diff: The time since the last timer printout was called
                 - total: The time since this timing block was started
                 - message: The message passed to this timing printout
+                - probes: The measurements of the probes (if any) since the last timer printout (appended to the
+                  message automatically if the format doesn't include it)
     :param verbose: If False, suppress printing messages
+    :param probes: Other measurements to take between printouts (see ``timed_call``). Since there's no telling when
+     the last printout has been made, 'alloc' requires ``tracemalloc`` to be started (and stopped) by the caller, and
+     is left out of ``probes=True`` when it isn't running
     :return: A function that reports run times when called
     """
+    names = _probe_names(probes)
+    if 'alloc' in names and not tracemalloc.is_tracing():
+        if probes is not True:
+            raise ValueError("tic's 'alloc' probe needs tracemalloc to be running (call tracemalloc.start() first)")
+        names = tuple(name for name in names if name != 'alloc')
+    if names and '{probes' not in fmt:
+        fmt += ' [{probes}]'
+    tokens = _start_probes(names)
     first_time = last_time = time()
 
     def toc(message=None):
@@ -47,17 +614,512 @@ def tic(log_level='DEBUG', fmt="{file}:{line} - {message} - {diff:0.6f}s (total=
         :param message: The message to print with this particular runtime
         :return: The time difference (in seconds) since the last tic or toc
         """
-        nonlocal last_time
+        nonlocal last_time, tokens
 
         now = time()
         diff = now - last_time
         total = now - first_time
+        probes = _format_probes(_stop_probes(names, tokens)) if names else ''
 
-        if verbose:
-            file, line, func, code_text = traceback.extract_stack(limit=2)[0]
+        if verbose and is_enabled_for(log_level):
+            file, line, func, code_text = _call_site(sys._getframe(1))
             log(log_level, fmt.format(**locals()))
 
+        tokens = _start_probes(names)
         last_time = time()
         return diff
 
     return toc
+
+
+# (code object, line number) -> (file, line, function, source text) of every call site seen so far
+_call_sites = {}
+
+
+def _call_site(frame):
+    """Describes where a frame currently is, reading its source line only the first time each location is seen"""
+    key = (frame.f_code, frame.f_lineno)
+    site = _call_sites.get(key)
+    if site is None:
+        code = frame.f_code
+        site = _call_sites[key] = (code.co_filename, frame.f_lineno, code.co_name,
+                                   linecache.getline(code.co_filename, frame.f_lineno).strip())
+    return site
+
+
+class _SectionNode:
+    """A node in the tree of timed sections: its timing totals, and the sections entered while it was running"""
+
+    def __init__(self, name, site=None, path=()):
+        self.name = name
+        self.site = site
+        # The names of this section and the sections it's nested in, outermost first
+        self.path = path
+        self.count = 0
+        self.total_ns = 0
+        self.children = {}
+
+    @property
+    def total(self):
+        """The time spent in this section, in seconds"""
+        return self.total_ns / 1e9
+
+    @property
+    def self_time(self):
+        """The time spent in this section outside of any of its sub-sections, in seconds"""
+        return (self.total_ns - sum(child.total_ns for child in self.children.values())) / 1e9
+
+
+_section_root = _SectionNode('<root>')
+_sections_lock = Lock()
+# Each thread's stack of currently running sections, as (node, start time in ns)
+_section_stacks = local()
+
+
+def _section_stack():
+    try:
+        return _section_stacks.stack
+    except AttributeError:
+        stack = _section_stacks.stack = []
+        return stack
+
+
+class section:
+    """Times a block of code (``with timing.section('load'):``) or every call to a function (``@timing.section()``) as
+    a node in a tree of nested sections. Sections entered while another is running become its children, and each
+    section accumulates its call count and total time across all of its runs (and all threads). See
+    ``section_report``.
+
+    :param name: The section's name. Defaults to the decorated function's name, or to the ``file:line`` the block is
+     entered from
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def __enter__(self):
+        stack = _section_stack()
+        parent = stack[-1][0] if stack else _section_root
+        name = self.name
+        site = None
+        if name is None:
+            site = _call_site(sys._getframe(1))
+            name = '{}:{}'.format(os.path.basename(site[0]), site[1])
+        node = parent.children.get(name)
+        if node is None:
+            with _sections_lock:
+                node = parent.children.get(name)
+                if node is None:
+                    node = parent.children[name] = _SectionNode(name, site, parent.path + (name,))
+        stack.append((node, perf_counter_ns()))
+        return self
+
+    def __exit__(self, *exc_info):
+        end = perf_counter_ns()
+        node, start = _section_stack().pop()
+        with _sections_lock:
+            node.count += 1
+            node.total_ns += end - start
+        if _trace_spans is not None:
+            _trace_spans.append((node.path, start, end, _pid, get_ident()))
+
+    def __call__(self, func):
+        if not enabled:
+            return func
+        timer = section(self.name or func.__qualname__)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with timer:
+                return func(*args, **kwargs)
+
+        return timed
+
+
+def section_report(min_fraction=0):
+    """Summarizes the tree of timed sections, with each section indented under the section it ran in, showing its total
+    time along with its self time (the time not spent in any of its sub-sections)
+
+    :param min_fraction: Leave out sections that took less than this fraction of their top-level section's time
+    :return: The report, as a string
+    """
+    lines = ['{:<60} {:>9} {:>10} {:>10}'.format('section', 'calls', 'total (s)', 'self (s)')]
+
+    def visit(node, depth, top_ns):
+        for child in sorted(node.children.values(), key=lambda c: c.total_ns, reverse=True):
+            top = top_ns if top_ns is not None else child.total_ns
+            if child.count and child.total_ns >= min_fraction * top:
+                lines.append('{:<60} {:>9} {:>10.4f} {:>10.4f}'.format(
+                    '  ' * depth + child.name, child.count, child.total, child.self_time))
+                visit(child, depth + 1, top)
+
+    with _sections_lock:
+        visit(_section_root, 0, None)
+    return '\n'.join(lines)
+
+
+def reset_sections():
+    """Clears the tree of timed sections (sections that are currently running keep timing into their old nodes)"""
+    with _sections_lock:
+        _section_root.children = {}
+
+
+# The spans recorded by the active Trace (in this process), or None if nothing's being traced
+_trace_spans = None
+_pid = os.getpid()
+# Worker processes find the active trace's directory through this environment variable
+_TRACE_DIRECTORY = 'MINIUTILS_TRACE_DIR'
+_DEFAULT_MAX_SPANS = 1000000
+
+
+def _record_worker_trace(directory, max_spans):
+    """Records spans in a worker process, saving them to the trace directory for the parent when the worker exits"""
+    global _trace_spans
+    _trace_spans = deque(maxlen=max_spans)
+    _save_trace_at_exit()
+
+
+def _save_trace_at_exit(*_):
+    spans = _trace_spans
+    if spans is None:
+        return
+    directory = os.environ[_TRACE_DIRECTORY]
+
+    def save():
+        if spans:
+            with open(os.path.join(directory, '{}.pkl'.format(os.getpid())), 'wb') as f:
+                pickle.dump(list(spans), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Multiprocessing workers skip atexit, but run these finalizers as they exit (as do normal processes, at exit)
+    multiprocessing.util.Finalize(None, save, exitpriority=10)
+
+
+def _after_fork():
+    global _pid, _sections_lock
+    _pid = os.getpid()
+    # Any of these could have been held by another thread at the time of the fork
+    _sections_lock = Lock()
+    for st in timing_stats.values():
+        st._lock = Lock()
+    if _trace_spans is not None:
+        # Start the child's own buffer, instead of re-saving the parent's spans
+        _record_worker_trace(os.environ[_TRACE_DIRECTORY], _trace_spans.maxlen)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+# Multiprocessing clears its finalizers after forking a new worker, so they need to be registered again
+multiprocessing.util.register_after_fork(_save_trace_at_exit, _save_trace_at_exit)
+
+if os.path.isdir(os.environ.get(_TRACE_DIRECTORY, '')):
+    # A spawned worker of a process that's tracing
+    _record_worker_trace(os.environ[_TRACE_DIRECTORY], _DEFAULT_MAX_SPANS)
+
+
+class Trace:
+    """Records every ``section`` as a span (with its process and thread), to see what each thread and process was doing
+    over time. Spans recorded in worker processes (e.g., ``parallel_progbar`` workers, or a process pool) started
+    while tracing are merged back in when the trace stops, as long as the workers exit normally. Use as a context
+    manager, or call ``start`` and ``stop``::
+
+        with timing.Trace() as trace:
+            parallel_progbar(work, items)
+        trace.write_chrome_trace('trace.json')  # Open in chrome://tracing or Perfetto
+        trace.write_collapsed('stacks.txt')  # Feed to flamegraph.pl or speedscope
+
+    Only one trace can be active at a time.
+
+    :param max_spans: The most spans to keep per process (the oldest are dropped first)
+    """
+
+    def __init__(self, max_spans=_DEFAULT_MAX_SPANS):
+        self.max_spans = max_spans
+        # (section path, start ns, end ns, process id, thread id)
+        self.spans = []
+        self.directory = None
+
+    def start(self):
+        global _trace_spans
+        if _trace_spans is not None:
+            raise RuntimeError("A trace is already being recorded")
+        self.directory = tempfile.mkdtemp(prefix='miniutils-trace-')
+        os.environ[_TRACE_DIRECTORY] = self.directory
+        _trace_spans = deque(maxlen=self.max_spans)
+        return self
+
+    def stop(self):
+        global _trace_spans
+        if self.directory is None:
+            raise RuntimeError("This trace hasn't been started")
+        spans, _trace_spans = _trace_spans, None
+        os.environ.pop(_TRACE_DIRECTORY, None)
+        self.spans.extend(spans or ())
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.pkl'))):
+            with open(path, 'rb') as f:
+                self.spans.extend(pickle.load(f))
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+        self.spans.sort(key=lambda span: span[1])
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def chrome_trace(self):
+        """The spans as Chrome trace events (a dictionary that can be saved as JSON), in microseconds"""
+        origin = self.spans[0][1] if self.spans else 0
+        events = [{'name': path[-1], 'cat': 'section', 'ph': 'X', 'ts': (start - origin) / 1000,
+                   'dur': (end - start) / 1000, 'pid': pid, 'tid': tid, 'args': {'path': '/'.join(path)}}
+                  for path, start, end, pid, tid in self.spans]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def collapsed(self):
+        """The spans as collapsed stacks (one ``outer;inner;innermost <self time in microseconds>`` line per stack),
+        the input format for flame graph tools"""
+        totals = defaultdict(int)
+        for path, start, end, _, _ in self.spans:
+            totals[path] += end - start
+        nested = defaultdict(int)
+        for path, total in totals.items():
+            if len(path) > 1:
+                nested[path[:-1]] += total
+        lines = []
+        for path in sorted(totals):
+            self_time = (totals[path] - nested[path]) // 1000
+            if self_time > 0:
+                lines.append('{} {}'.format(';'.join(path), self_time))
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, file):
+        """Saves the spans as a Chrome trace-event JSON file
+
+        :param file: A path or writable file object
+        """
+        if isinstance(file, str):
+            with open(file, 'w') as f:
+                json.dump(self.chrome_trace(), f)
+        else:
+            json.dump(self.chrome_trace(), file)
+
+    def write_collapsed(self, file):
+        """Saves the spans as collapsed stacks, for flame graph tools
+
+        :param file: A path or writable file object
+        """
+        if isinstance(file, str):
+            with open(file, 'w') as f:
+                f.write(self.collapsed() + '\n')
+        else:
+            file.write(self.collapsed() + '\n')
+
+
+# Labels for the functions seen by sample_profile, by code object
+_code_labels = {}
+
+
+def _code_label(code):
+    label = _code_labels.get(code)
+    if label is None:
+        label = _code_labels[code] = '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                          code.co_firstlineno)
+    return label
+
+
+class sample_profile:
+    """A sampling profiler: while it runs, it periodically looks at what the profiled thread (or every thread) is
+    doing, and counts how often each call stack is seen. Unlike a deterministic profiler, this costs nothing per
+    function call, so it doesn't distort code with many small calls; its overhead is set by the sampling interval
+    instead. Use it as a context manager, as a decorator (samples from every call accumulate in the decorated
+    function's ``profile``), or call ``start`` and ``stop``::
+
+        with timing.sample_profile() as profile:
+            run_pipeline()
+        print(profile.report(top=20))
+        profile.write_collapsed('stacks.txt')  # Feed to flamegraph.pl or speedscope
+
+    There are two ways to take samples. By default (``clock='wall'``), a background thread wakes up every
+    ``interval`` and reads the stacks with ``sys._current_frames``, so time spent waiting (on I/O, locks, or sleeps)
+    shows up as well. While other threads are busy running Python code, the watcher has to wait its turn for the GIL,
+    which can stretch the interval up to ``sys.getswitchinterval()``. With ``clock='cpu'``, a ``SIGPROF`` timer
+    interrupts the process every ``interval`` of CPU time instead, so only time spent computing is counted; this needs
+    ``signal.setitimer`` (not on Windows), and has to be started from the main thread, which it samples.
+
+    :param interval: The time between samples, in seconds
+    :param all_threads: Sample every thread (each stack is rooted at its thread's name), instead of only the thread
+     that started the profile
+    :param clock: ``'wall'`` or ``'cpu'``, as described above
+    """
+
+    def __init__(self, interval=0.005, all_threads=False, clock='wall'):
+        if clock not in ('wall', 'cpu'):
+            raise ValueError("clock must be 'wall' or 'cpu', not {!r}".format(clock))
+        self.interval = interval
+        self.all_threads = all_threads
+        self.clock = clock
+        # The number of times each stack was seen, keyed by (thread id, code objects from outermost to innermost)
+        self.counts = defaultdict(int)
+        self.samples = 0
+        # The time spent running, and the time spent taking samples, in ns
+        self.elapsed_ns = 0
+        self.overhead_ns = 0
+        self._thread_names = {}
+        self._depth = 0
+        self._start_ns = None
+        self._watcher = None
+        self._stop_event = None
+        self._previous_handler = None
+
+    def _record(self, frame, thread_id):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack.reverse()
+        self.counts[thread_id, tuple(stack)] += 1
+
+    def _sample(self, frames):
+        start = perf_counter_ns()
+        if self.all_threads:
+            watcher = self._watcher.ident if self._watcher is not None else None
+            for thread_id, frame in frames.items():
+                if thread_id != watcher:
+                    self._record(frame, thread_id)
+        else:
+            frame = frames.get(self._thread_id)
+            if frame is not None:
+                self._record(frame, self._thread_id)
+        self.samples += 1
+        self.overhead_ns += perf_counter_ns() - start
+
+    def _watch(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            if self._stop_event.is_set():
+                # Don't count the profiled thread waiting for this one to stop
+                break
+            self._sample(frames)
+
+    def _on_signal(self, signum, frame):
+        if self.all_threads:
+            frames = sys._current_frames()
+            # Use the interrupted frame, rather than this handler's, for the main thread
+            frames[self._thread_id] = frame
+            self._sample(frames)
+        else:
+            self._sample({self._thread_id: frame})
+
+    def start(self):
+        self._depth += 1
+        if self._depth > 1:
+            # Already running (e.g., a recursive call to a decorated function)
+            return self
+        self._thread_id = get_ident()
+        if self.clock == 'cpu':
+            self._previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._stop_event = Event()
+            self._watcher = Thread(target=self._watch, name='miniutils-sample-profile', daemon=True)
+            self._watcher.start()
+        self._start_ns = perf_counter_ns()
+        return self
+
+    def stop(self):
+        if self._depth == 0:
+            raise RuntimeError("This profile hasn't been started")
+        self._depth -= 1
+        if self._depth > 0:
+            return self
+        self.elapsed_ns += perf_counter_ns() - self._start_ns
+        if self.clock == 'cpu':
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+        else:
+            self._stop_event.set()
+            self._watcher.join()
+            self._watcher = None
+        self._thread_names.update((t.ident, t.name) for t in threading.enumerate())
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __call__(self, func):
+        if not enabled:
+            return func
+
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        profiled.profile = self
+        return profiled
+
+    def stacks(self):
+        """The number of samples of each call stack, as a dictionary keyed by tuples of function labels (``name
+        (file:line)``), outermost first"""
+        stacks = defaultdict(int)
+        for (thread_id, codes), count in self.counts.items():
+            stack = tuple(_code_label(code) for code in codes)
+            if self.all_threads:
+                stack = (self._thread_names.get(thread_id, 'thread-{}'.format(thread_id)),) + stack
+            stacks[stack] += count
+        return stacks
+
+    def collapsed(self):
+        """The samples as collapsed stacks (one ``outer;inner;innermost <sample count>`` line per stack), the input
+        format for flame graph tools"""
+        return '\n'.join('{} {}'.format(';'.join(stack), count) for stack, count in sorted(self.stacks().items()))
+
+    def write_collapsed(self, file):
+        """Saves the samples as collapsed stacks, for flame graph tools
+
+        :param file: A path or writable file object
+        """
+        if isinstance(file, str):
+            with open(file, 'w') as f:
+                f.write(self.collapsed() + '\n')
+        else:
+            file.write(self.collapsed() + '\n')
+
+    def top(self, n=None, sort_by='self'):
+        """The functions seen most often, as ``(label, self samples, total samples)``. A function's self samples are
+        the samples where it was the one running; its total samples also count the samples where it was waiting on a
+        function it called
+
+        :param n: How many functions to return (all of them if None)
+        :param sort_by: ``'self'`` or ``'total'``
+        :return: A list of tuples, most often seen first
+        """
+        self_counts = defaultdict(int)
+        total_counts = defaultdict(int)
+        for stack, count in self.stacks().items():
+            if not stack:
+                continue
+            self_counts[stack[-1]] += count
+            for label in set(stack):
+                total_counts[label] += count
+        rows = [(label, self_counts[label], total) for label, total in total_counts.items()]
+        rows.sort(key=lambda row: row[1] if sort_by == 'self' else row[2], reverse=True)
+        return rows[:n] if n is not None else rows
+
+    def report(self, top=20, sort_by='self'):
+        """Summarizes the functions seen most often (see ``top``) as a table, with the share of samples each was seen
+        in
+
+        :return: The report, as a string
+        """
+        samples = sum(self.counts.values()) or 1
+        lines = ['{} samples over {:0.3f}s (sampling took {:0.1f}% of that)'.format(
+                     self.samples, self.elapsed_ns / 1e9, 100 * self.overhead_ns / max(self.elapsed_ns, 1)),
+                 '{:>8} {:>8}  {}'.format('self %', 'total %', 'function')]
+        for label, self_count, total in self.top(top, sort_by):
+            lines.append('{:>8.1f} {:>8.1f}  {}'.format(100 * self_count / samples, 100 * total / samples, label))
+        return '\n'.join(lines)
@@ -16,7 +16,10 @@ setup(
         'coloredlogs',
         'astor',
     ],
+    entry_points={
+        'console_scripts': ['miniutils-bench = miniutils.bench:main'],
+    },
     download_url='https://github.com/scnerd/miniutils',
     keywords=['miniutils', 'utilities', 'decorators', 'minimal'],
-    python_requires='>=3',
+    python_requires='>=3.7',
 )
@@ -0,0 +1,119 @@
+import tracemalloc
+from threading import Thread
+from time import perf_counter
+from unittest import TestCase
+
+from miniutils.caching import CachedProperty
+
+
+class Plain:
+    def __init__(self, x):
+        self.x = x
+
+    @CachedProperty('b')
+    def a(self):
+        return self.x + 1
+
+    @CachedProperty('c')
+    def b(self):
+        return self.a + 1
+
+    @CachedProperty()
+    def c(self):
+        return self.b + 1
+
+
+class Compact:
+    def __init__(self, x):
+        self.x = x
+
+    @CachedProperty('b', compact=True)
+    def a(self):
+        return self.x + 1
+
+    @CachedProperty('c', compact=True)
+    def b(self):
+        return self.a + 1
+
+    @CachedProperty(compact=True)
+    def c(self):
+        return self.b + 1
+
+
+class CompactSlots:
+    __slots__ = ('x', '_cached_values')
+
+    def __init__(self, x):
+        self.x = x
+
+    @CachedProperty('b', compact=True)
+    def a(self):
+        return self.x + 1
+
+    @CachedProperty('c', compact=True)
+    def b(self):
+        return self.a + 1
+
+    @CachedProperty(compact=True)
+    def c(self):
+        return self.b + 1
+
+
+def _bytes_per_instance(cls, n=20000):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [cls(i) for i in range(n)]
+    for o in objs:
+        o.c
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / n
+
+
+class Hot:
+    @CachedProperty()
+    def threadsafe(self):
+        return 1
+
+    @CachedProperty(threadsafe=False)
+    def unsafe(self):
+        return 1
+
+    @CachedProperty(compact=True)
+    def compact(self):
+        return 1
+
+
+def _threaded_reads_per_second(name, nthreads=4, nreads=200000):
+    obj = Hot()
+    getattr(obj, name)
+
+    def read():
+        for _ in range(nreads):
+            getattr(obj, name)
+
+    threads = [Thread(target=read) for _ in range(nthreads)]
+    start = perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return nthreads * nreads / (perf_counter() - start)
+
+
+class TestCachingMemory(TestCase):
+    def test_compact_memory(self):
+        plain = _bytes_per_instance(Plain)
+        compact = _bytes_per_instance(Compact)
+        slots = _bytes_per_instance(CompactSlots)
+        print("Bytes per instance: plain={:0.0f}, compact={:0.0f}, compact+slots={:0.0f}".format(plain, compact,
+                                                                                                  slots))
+        self.assertLess(compact, plain)
+        self.assertLess(slots, compact)
+
+
+class TestCachingThroughput(TestCase):
+    def test_hot_threaded_reads(self):
+        rates = {name: _threaded_reads_per_second(name) for name in ('threadsafe', 'unsafe', 'compact')}
+        print("Cached reads/s across 4 threads: " + ", ".join("{}={:0.0f}".format(k, v) for k, v in rates.items()))
+        print("Threadsafe hit overhead: {:0.2f}x".format(rates['unsafe'] / rates['threadsafe']))
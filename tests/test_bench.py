@@ -0,0 +1,104 @@
+import io
+import json
+import os
+import tempfile
+from contextlib import redirect_stdout, redirect_stderr
+from unittest import TestCase
+
+from miniutils import bench
+
+
+class TestBench(TestCase):
+    def setUp(self):
+        self._registered = bench.benchmarks.copy()
+        bench.benchmarks.clear()
+
+    def tearDown(self):
+        bench.benchmarks.clear()
+        bench.benchmarks.update(self._registered)
+
+    def test_register_and_run(self):
+        calls = []
+
+        @bench.benchmark
+        def plain():
+            calls.append(1)
+
+        @bench.benchmark(name='with_setup', setup=lambda: list(range(100)))
+        def summed(lst):
+            return sum(lst)
+
+        self.assertIs(plain, bench.benchmarks[plain.__module__ + '.' + plain.__qualname__].func)
+        results = bench.run_all(repeat=3, min_time=0.002, warmup=0)
+        self.assertEqual(list(results), list(bench.benchmarks))
+        for result in results.values():
+            self.assertEqual(len(result.times), 3)
+            self.assertGreaterEqual(result.loops * result.median * 3, 0.002)
+            self.assertEqual(result.stats.count, 3)
+        self.assertGreater(len(calls), results[next(iter(results))].loops * 3)  # Plus the calibration runs
+
+        self.assertEqual(list(bench.run_all('with_*', repeat=1, min_time=0.001, warmup=0)), ['with_setup'])
+
+    def test_statistics(self):
+        result = bench.BenchmarkResult('b', 1, [1, 2, 3, 4, 100])
+        self.assertEqual(result.median, 3)
+        self.assertAlmostEqual(result.mad, 1.4826)
+        self.assertEqual(result.iqr, 2)
+        self.assertEqual(result.min, 1)
+        self.assertEqual(result.mean, 22)
+        self.assertEqual(result.outliers, 1)
+
+    def test_save_and_compare(self):
+        baseline = {'fast': bench.BenchmarkResult('fast', 10, [1.0, 1.01, 0.99]),
+                    'slow': bench.BenchmarkResult('slow', 10, [1.0, 1.01, 0.99]),
+                    'noisy': bench.BenchmarkResult('noisy', 10, [1.0, 2.0, 0.5])}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'baseline.json')
+            bench.save_results(baseline, path)
+            with open(path) as f:
+                self.assertEqual(json.load(f)['benchmarks']['fast']['median'], 1.0)
+            baseline = bench.load_results(path)
+
+        results = {'fast': bench.BenchmarkResult('fast', 10, [1.05, 1.04, 1.06]),
+                   'slow': bench.BenchmarkResult('slow', 10, [1.5, 1.51, 1.49]),
+                   'noisy': bench.BenchmarkResult('noisy', 10, [1.5, 2.5, 0.8]),
+                   'new': bench.BenchmarkResult('new', 10, [1.0])}
+        comparisons = {c.name: c for c in bench.compare(results, baseline, tolerance=0.1)}
+        self.assertEqual(set(comparisons), {'fast', 'slow', 'noisy'})
+        self.assertFalse(comparisons['fast'].regressed)
+        self.assertTrue(comparisons['slow'].regressed)
+        self.assertAlmostEqual(comparisons['slow'].ratio, 1.5)
+        self.assertFalse(comparisons['noisy'].regressed)  # 1.5x slower, but within the noise
+
+        with self.assertRaisesRegex(bench.BenchmarkRegression, 'slow'):
+            bench.assert_no_regressions(results, baseline)
+        bench.assert_no_regressions(results, baseline, tolerance=1)
+        self.assertIn('1.500x !', bench.report(results, baseline))
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            module = os.path.join(tmp, 'my_benchmarks.py')
+            with open(module, 'w') as f:
+                f.write('from miniutils.bench import benchmark\n'
+                        '@benchmark(name="noop")\n'
+                        'def noop():\n'
+                        '    pass\n')
+            results = os.path.join(tmp, 'results.json')
+            out = io.StringIO()
+            with redirect_stdout(out):
+                code = bench.main([module, '--repeat', '2', '--min-time', '0.001', '--warmup', '0', '--save', results])
+            self.assertEqual(code, 0)
+            self.assertIn('noop', out.getvalue())
+            self.assertEqual(list(bench.load_results(results)), ['noop'])
+
+            # Pretend the baseline was a hundred times faster
+            with open(results) as f:
+                data = json.load(f)
+            data['benchmarks']['noop']['times'] = [t / 100 for t in data['benchmarks']['noop']['times']]
+            with open(results, 'w') as f:
+                json.dump(data, f)
+            err = io.StringIO()
+            with redirect_stdout(io.StringIO()), redirect_stderr(err):
+                code = bench.main(['--repeat', '2', '--min-time', '0.001', '--warmup', '0', '--baseline', results])
+            self.assertEqual(code, 1)
+            self.assertIn('noop', err.getvalue())
@@ -1,9 +1,17 @@
-from collections import defaultdict
+import asyncio
+from collections import defaultdict, deque
+import copy
+import os
+import pickle
+import signal
+from threading import Barrier, Thread
+from time import perf_counter, sleep
 from unittest import TestCase
+import warnings
 
 import numpy as np
 
-from miniutils.caching import CachedProperty
+from miniutils.caching import CachedCollection, CachedProperty, CachedMethod, warm
 from miniutils.capture_output import captured_output
 
 
@@ -100,11 +108,344 @@ class CollectionProperties:
     def locked_defaultdict(self):
         return defaultdict(int, dict(a=1, b=2, c=3))
 
+    @CachedProperty('target', is_collection=True)
+    def basic_deque(self):
+        return deque([1, 2, 3])
+
+    @CachedProperty('target', is_collection=True)
+    def basic_array(self):
+        return np.array([3, 1, 2])
+
     @CachedProperty()
     def target(self):
         return True
 
 
+class CompactPrinter:
+    @CachedProperty('b', settable=True, compact=True)
+    def a(self):
+        print("Running a")
+        return 5
+
+    @CachedProperty('c', is_collection=True, settable=True, compact=True)
+    def b(self):
+        print("Running b")
+        return [self.a] * 100
+
+    @CachedProperty(threadsafe=False, compact=True)
+    def c(self):
+        print("Running c")
+        return sum(self.b)
+
+
+class SlottedCompact:
+    __slots__ = ('x', '_cached_values')
+
+    def __init__(self, x):
+        self.x = x
+
+    @CachedProperty('double', settable=True, compact=True)
+    def value(self):
+        return self.x
+
+    @CachedProperty(compact=True)
+    def double(self):
+        return self.value * 2
+
+
+class SlottedWeakrefCompact:
+    __slots__ = ('x', '__weakref__')
+
+    def __init__(self, x):
+        self.x = x
+
+    @CachedProperty(compact=True)
+    def value(self):
+        return [self.x]
+
+
+class SlowCounter:
+    def __init__(self):
+        self.runs = 0
+
+    @CachedProperty()
+    def value(self):
+        self.runs += 1
+        sleep(0.05)
+        return self.runs
+
+    @CachedProperty(compact=True)
+    def compact_value(self):
+        self.runs += 1
+        sleep(0.05)
+        return self.runs
+
+
+class Polynomial:
+    def __init__(self, coefficients):
+        self.calls = 0
+        self.coefficients = coefficients
+
+    @CachedProperty('evaluate', 'derivative', settable=True)
+    def coefficients(self):
+        return []
+
+    @CachedMethod(maxsize=2)
+    def evaluate(self, x, scale=1):
+        self.calls += 1
+        return scale * sum(c * x ** i for i, c in enumerate(self.coefficients))
+
+    @CachedMethod('slope_sign')
+    def derivative(self, x):
+        return sum(i * c * x ** (i - 1) for i, c in enumerate(self.coefficients) if i)
+
+    @CachedProperty()
+    def slope_sign(self):
+        return self.derivative(0) > 0
+
+    @CachedMethod(ttl=0.05, key=lambda x: round(x))
+    def rounded(self, x):
+        self.calls += 1
+        return round(x) * 10
+
+
+class BigArrays:
+    def __init__(self, n):
+        self.n = n
+        self.runs = 0
+
+    @CachedProperty('total')
+    def array(self):
+        self.runs += 1
+        return np.zeros(self.n)
+
+    @CachedProperty()
+    def total(self):
+        return self.array.sum()
+
+    @CachedProperty(settable=True)
+    def assigned(self):
+        return np.zeros(self.n)
+
+
+def make_persisted_class(directory):
+    class Persisted:
+        computed = []
+
+        def __init__(self, n):
+            self.n = n
+
+        @CachedProperty('summary', persist=directory, fingerprint=lambda self: str(self.n))
+        def array(self):
+            Persisted.computed.append('array')
+            return np.arange(self.n, dtype=float)
+
+        @CachedProperty(persist=directory)
+        def summary(self):
+            Persisted.computed.append('summary')
+            return {'n': self.n, 'total': float(self.array.sum())}
+
+    return Persisted
+
+
+class Batched:
+    def __init__(self):
+        self.invalidations = 0
+
+    @CachedProperty('total', 'watcher', is_collection=True, settable=True)
+    def items(self):
+        return []
+
+    @CachedProperty('watcher', settable=True)
+    def offset(self):
+        return 0
+
+    @CachedProperty()
+    def total(self):
+        return sum(self.items) + self.offset
+
+    @property
+    def watcher(self):
+        return self.invalidations
+
+    @watcher.deleter
+    def watcher(self):
+        self.invalidations += 1
+
+
+class AsyncSource:
+    def __init__(self):
+        self.fetches = 0
+        self.fail = False
+
+    @CachedProperty('doubled', settable=True)
+    async def value(self):
+        self.fetches += 1
+        await asyncio.sleep(0.02)
+        if self.fail:
+            raise ValueError("fetch failed")
+        return self.fetches
+
+    @CachedProperty()
+    async def doubled(self):
+        return 2 * await self.value
+
+
+class Pipeline:
+    def __init__(self):
+        self.n = 10
+
+    @CachedProperty('total')
+    def a(self):
+        sleep(0.1)
+        return self.n
+
+    @CachedProperty('total')
+    def b(self):
+        sleep(0.1)
+        return self.n * 2
+
+    @CachedProperty('total', 'doubled', is_collection=True)
+    def c(self):
+        sleep(0.1)
+        return [self.n] * 3
+
+    @CachedProperty()
+    def total(self):
+        sleep(0.1)
+        return self.a + self.b + sum(self.c)
+
+    @CachedProperty()
+    def doubled(self):
+        return [2 * x for x in self.c]
+
+    @CachedProperty()
+    async def not_warmed(self):
+        return 1
+
+
+class ProcessPipeline:
+    def __init__(self):
+        self.n = 10
+
+    @CachedProperty('total')
+    def a(self):
+        sleep(0.1)
+        return self.n
+
+    @CachedProperty('total')
+    def b(self):
+        sleep(0.1)
+        return np.arange(self.n)
+
+    @CachedProperty()
+    def total(self):
+        return self.a + self.b.sum()
+
+
+class Instrumented:
+    @CachedProperty('slow')
+    def fast(self):
+        return 1
+
+    @CachedProperty()
+    def slow(self):
+        sleep(0.02)
+        return np.zeros(100)
+
+
+class RunningTotal:
+    def __init__(self):
+        self.recomputes = 0
+        self.updates = 0
+
+    @CachedProperty('total', 'count', 'mean', is_collection=True, settable=True)
+    def items(self):
+        return [1, 2, 3]
+
+    @CachedProperty('mean')
+    def total(self):
+        self.recomputes += 1
+        return sum(self.items)
+
+    @total.incremental
+    def total(self, previous, mutations):
+        self.updates += 1
+        for m in mutations:
+            if m.method == 'append':
+                previous += m.args[0]
+            elif m.method == '__setitem__':
+                previous += m.args[1] - m.previous
+            elif m.method == '__delitem__':
+                previous -= m.previous
+            else:
+                return sum(self.items)
+        return previous
+
+    @CachedProperty('mean')
+    def count(self):
+        return len(self.items)
+
+    @CachedProperty()
+    def mean(self):
+        return self.total / self.count
+
+
+class Shippable:
+    def __init__(self):
+        self.computes = 0
+
+    @CachedProperty('total', is_collection=True)
+    def items(self):
+        return [1, 2, 3]
+
+    @CachedProperty()
+    def total(self):
+        self.computes += 1
+        return sum(self.items)
+
+    @CachedProperty(serialize=False)
+    def scratch(self):
+        return [0] * 10
+
+    @CachedProperty(compact=True)
+    def label(self):
+        self.computes += 1
+        return 'shippable'
+
+
+class SlottedShippable:
+    __slots__ = ('n', '_cached_values')
+
+    def __init__(self, n):
+        self.n = n
+
+    @CachedProperty(compact=True)
+    def square(self):
+        return self.n ** 2
+
+
+class Expiring:
+    def __init__(self):
+        self.version = 0
+        self.refreshes = 0
+
+    @CachedProperty('doubled', ttl=0.1)
+    def value(self):
+        self.version += 1
+        return self.version
+
+    @CachedProperty()
+    def doubled(self):
+        return self.value * 2
+
+    @CachedProperty(ttl=0.1, stale_while_revalidate=True)
+    def slow(self):
+        sleep(0.1)
+        self.refreshes += 1
+        return self.refreshes
+
+
 class TestCachedProperty(TestCase):
     def test_matrix(self):
         np.random.seed(0)
@@ -148,6 +489,71 @@ class TestCachedProperty(TestCase):
 
         self.assertRaises(AttributeError, try_not_allowed)
 
+    def test_custom_setter(self):
+        class Celsius:
+            def __init__(self):
+                self.kelvin = 273.15
+
+            @CachedProperty('fahrenheit')
+            def celsius(self):
+                return self.kelvin - 273.15
+
+            @celsius.setter
+            def celsius(self, value):
+                self.kelvin = value + 273.15
+
+            @celsius.deleter
+            def celsius(self):
+                self.kelvin = 273.15
+
+            @CachedProperty()
+            def fahrenheit(self):
+                return self.celsius * 9 / 5 + 32
+
+        t = Celsius()
+        self.assertAlmostEqual(t.fahrenheit, 32)
+        t.celsius = 100
+        self.assertAlmostEqual(t.kelvin, 373.15)
+        self.assertAlmostEqual(t.celsius, 100)
+        self.assertAlmostEqual(t.fahrenheit, 212)
+        del t.celsius
+        self.assertAlmostEqual(t.fahrenheit, 32)
+
+    def test_custom_setter_incremental(self):
+        class Offset:
+            def __init__(self):
+                self.offset = 0
+                self.updates = 0
+
+            @CachedProperty('total', is_collection=True, settable=True)
+            def items(self):
+                return [1, 2, 3]
+
+            @CachedProperty()
+            def total(self):
+                return sum(self.items) + self.offset
+
+            @total.setter
+            def total(self, value):
+                self.offset = value - sum(self.items)
+
+            @total.incremental
+            def total(self, previous, mutations):
+                self.updates += 1
+                return previous + sum(m.args[0] for m in mutations)
+
+        o = Offset()
+        self.assertEqual(o.total, 6)
+        o.items.append(4)
+        self.assertEqual(o.total, 10)
+        self.assertEqual(o.updates, 1)
+        o.total = 20
+        self.assertEqual(o.offset, 10)
+        self.assertEqual(o.total, 20)
+        o.items.append(5)
+        self.assertEqual(o.total, 25)
+        self.assertEqual(o.updates, 2)
+
     def test_mutable_collection_assign(self):
         i = CollectionProperties()
 
@@ -239,3 +645,639 @@ class TestCachedProperty(TestCase):
 
         i.basic_set.difference(i.basic_set)
         self.assertFalse(i._need_target)
+
+    def test_compact_printer(self):
+        with captured_output() as (out, err):
+            p = CompactPrinter()
+            self.assertEqual(p.c, 500)
+            p.b[0] = 0
+            self.assertEqual(p.c, 495)
+            p.b = [1, 2, 3]
+            self.assertEqual(p.c, 6)
+            del p.a
+            self.assertEqual(p.c, 500)
+        self.assertEqual(out().strip(), '\n'.join('Running {}'.format(s) for s in list('cbacccba')))
+        self.assertFalse(hasattr(p, '_need_a'))
+        self.assertFalse(hasattr(p, '_a'))
+        self.assertIsInstance(p._cached_values, list)
+
+    def test_compact_slots(self):
+        s = SlottedCompact(3)
+        self.assertEqual(s.double, 6)
+        s.value = 5
+        self.assertEqual(s.double, 10)
+        del s.value
+        self.assertEqual(s.double, 6)
+        self.assertEqual(SlottedCompact(4).double, 8)
+
+    def test_compact_side_table(self):
+        from miniutils import caching
+
+        s = SlottedWeakrefCompact(3)
+        self.assertEqual(s.value, [3])
+        self.assertIs(s.value, s.value)
+        self.assertIn(id(s), caching._compact_side_table)
+        key = id(s)
+        del s
+        self.assertNotIn(key, caching._compact_side_table)
+
+    def test_compact_requires_storage(self):
+        class Unstorable:
+            __slots__ = ()
+
+            @CachedProperty(compact=True)
+            def value(self):
+                return 1
+
+        self.assertRaises(TypeError, lambda: Unstorable().value)
+
+    def test_threadsafe_computes_once(self):
+        for name in ('value', 'compact_value'):
+            c = SlowCounter()
+            barrier = Barrier(8)
+            results = []
+
+            def read():
+                barrier.wait()
+                results.append(getattr(c, name))
+
+            threads = [Thread(target=read) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(c.runs, 1)
+            self.assertEqual(results, [1] * 8)
+
+    def test_invalidated_flag(self):
+        c = SlowCounter()
+        self.assertEqual(c.value, 1)
+        self.assertFalse(c._need_value)
+        del c.value
+        self.assertTrue(c._need_value)
+        self.assertFalse(hasattr(c, '_value'))
+        self.assertEqual(c.value, 2)
+
+    def test_invalidation_plan(self):
+        class Diamond:
+            @CachedProperty('left', 'right', settable=True)
+            def top(self):
+                return 1
+
+            @CachedProperty('bottom')
+            def left(self):
+                return self.top + 1
+
+            @CachedProperty('bottom')
+            def right(self):
+                return self.top + 2
+
+            @CachedProperty()
+            def bottom(self):
+                return self.left + self.right
+
+        plan = Diamond.top.plans[Diamond]
+        self.assertEqual(len(plan), 3)
+        self.assertIs(plan[-1], Diamond.bottom.reset)
+        self.assertEqual(set(plan), {Diamond.left.reset, Diamond.right.reset, Diamond.bottom.reset})
+
+        d = Diamond()
+        self.assertEqual(d.bottom, 5)
+        d.top = 10
+        self.assertTrue(d._need_left and d._need_right and d._need_bottom)
+        self.assertEqual(d.bottom, 23)
+
+    def test_invalidation_plan_plain_attribute(self):
+        class Plain:
+            @CachedProperty('b', settable=True)
+            def a(self):
+                return 1
+
+            @CachedProperty('c')
+            def b(self):
+                self.c = self.a + 1
+                return self.c
+
+        p = Plain()
+        p.a
+        del p.a  # b was never computed, so there's no c to delete
+        self.assertEqual(p.b, 2)
+        p.a = 5
+        self.assertFalse(hasattr(p, 'c'))
+        self.assertEqual(p.b, 6)
+
+    def test_invalidation_plan_subclass(self):
+        class Base:
+            @CachedProperty('derived', settable=True)
+            def source(self):
+                return 1
+
+            @CachedProperty()
+            def derived(self):
+                return self.source * 2
+
+        class Child(Base):
+            pass
+
+        c = Child()
+        self.assertEqual(c.derived, 2)
+        c.source = 5
+        self.assertEqual(c.derived, 10)
+        self.assertIn(Child, Base.source.plans)
+
+    def test_dependency_cycle(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+
+            class Cycle:
+                @CachedProperty('b', settable=True)
+                def a(self):
+                    return 1
+
+                @CachedProperty('a')
+                def b(self):
+                    return self.a + 1
+
+        self.assertEqual(len(caught), 1)
+        self.assertIn('a -> b -> a', str(caught[0].message))
+
+        c = Cycle()
+        self.assertEqual(c.b, 2)
+        c.a = 5
+        self.assertEqual(c.a, 5)
+        self.assertEqual(c.b, 6)
+        del c.b
+        self.assertEqual(c.b, 2)
+
+    def test_cached_method(self):
+        p = Polynomial([1, 2, 3])
+        self.assertEqual(p.evaluate(1), 6)
+        self.assertEqual(p.evaluate(1), 6)
+        self.assertEqual(p.calls, 1)
+        self.assertEqual(p.evaluate(1, scale=2), 12)
+        self.assertEqual(p.evaluate(1, 2), 12)
+        self.assertEqual(p.calls, 3)
+        self.assertEqual(Polynomial.evaluate.__name__, 'evaluate')
+
+    def test_cached_method_lru(self):
+        p = Polynomial([1, 2, 3])
+        p.evaluate(0)
+        p.evaluate(1)
+        p.evaluate(0)  # 0 is now more recently used than 1
+        p.evaluate(2)  # Evicts 1
+        self.assertEqual(p.calls, 3)
+        p.evaluate(0)
+        self.assertEqual(p.calls, 3)
+        p.evaluate(1)
+        self.assertEqual(p.calls, 4)
+
+    def test_cached_method_ttl_and_key(self):
+        p = Polynomial([])
+        self.assertEqual(p.rounded(1.2), 10)
+        self.assertEqual(p.rounded(0.9), 10)
+        self.assertEqual(p.calls, 1)
+        sleep(0.06)
+        self.assertEqual(p.rounded(1.1), 10)
+        self.assertEqual(p.calls, 2)
+
+    def test_cached_method_invalidation(self):
+        p = Polynomial([1, 2, 3])
+        self.assertEqual(p.evaluate(2), 17)
+        self.assertTrue(p.slope_sign)
+        p.coefficients = [1, -2]
+        self.assertEqual(p.evaluate(2), -3)
+        self.assertTrue(p._need_slope_sign)
+        self.assertFalse(p.slope_sign)
+
+        calls = p.calls
+        p.evaluate(2)
+        del p.evaluate
+        p.evaluate(2)
+        self.assertEqual(p.calls, calls + 1)
+
+        del p.derivative
+        self.assertTrue(p._need_slope_sign)
+
+    def test_memory_budget(self):
+        CachedProperty.set_memory_budget(3 * 8000)
+        try:
+            objs = [BigArrays(1000) for _ in range(5)]
+            for o in objs:
+                o.array
+            self.assertEqual([o.runs for o in objs], [1] * 5)
+            # Only the three most recently used arrays are still cached
+            self.assertEqual([hasattr(o, '_array') for o in objs], [False, False, True, True, True])
+
+            objs[2].array  # Now the most recently used
+            objs[0].array  # Recomputed, evicting objs[3]
+            self.assertEqual(objs[0].runs, 2)
+            self.assertEqual([hasattr(o, '_array') for o in objs], [True, False, True, False, True])
+
+            # Eviction doesn't invalidate dependents
+            self.assertEqual(objs[4].total, 0)
+            del objs[4].array
+            self.assertTrue(objs[4]._need_total)
+
+            # Assigned values are never evicted, and dead instances release their share of the budget
+            objs[1].assigned = np.zeros(5000)
+            for o in objs:
+                o.array
+            self.assertTrue(hasattr(objs[1], '_assigned'))
+            from miniutils import caching
+            used = caching._memory_budget.used
+            del objs[:]
+            self.assertLess(caching._memory_budget.used, used)
+        finally:
+            CachedProperty.set_memory_budget(None)
+
+    def test_persist(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            Persisted = make_persisted_class(d)
+            p = Persisted(10)
+            self.assertEqual(p.summary, {'n': 10, 'total': 45.0})
+            self.assertEqual(Persisted.computed, ['summary', 'array'])
+
+            # A "restart": a fresh class and instance, with the same fingerprint and source
+            Persisted = make_persisted_class(d)
+            p = Persisted(10)
+            self.assertEqual(p.summary, {'n': 10, 'total': 45.0})
+            self.assertIsInstance(p.array, np.memmap)
+            self.assertEqual(p.array.sum(), 45)
+            self.assertEqual(Persisted.computed, [])
+
+            # A different fingerprint is computed anew
+            q = Persisted(5)
+            self.assertEqual(q.summary, {'n': 5, 'total': 10.0})
+            self.assertEqual(Persisted.computed, ['summary', 'array'])
+
+    def test_persist_upstream_changes(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            runs = []
+
+            class Scaled:
+                @CachedProperty('total', settable=True)
+                def scale(self):
+                    return 1
+
+                @CachedProperty('total', is_collection=True)
+                def items(self):
+                    return [10]
+
+                @CachedProperty(persist=d)
+                def total(self):
+                    runs.append(1)
+                    return self.scale * sum(self.items)
+
+            o = Scaled()
+            self.assertEqual(o.total, 10)
+            o.scale = 5
+            self.assertEqual(o.total, 50)
+            o.items.append(2)
+            self.assertEqual(o.total, 60)
+            self.assertEqual(len(runs), 3)
+
+            # The same upstream values map back to the same disk entries
+            o.items.pop()
+            self.assertEqual(o.total, 50)
+            del o.total
+            self.assertEqual(o.total, 50)
+            self.assertEqual(len(runs), 3)
+
+    def test_collection_method_tables_complete(self):
+        from miniutils.caching import _READ_ONLY_METHODS, _MUTATING_METHODS
+
+        for cls in (list, dict, set, frozenset, deque, defaultdict):
+            table = cls if cls in _READ_ONLY_METHODS else dict
+            public = {name for name in dir(cls) if not name.startswith('_')}
+            self.assertEqual(_READ_ONLY_METHODS[table] & _MUTATING_METHODS[table], frozenset())
+            self.assertLessEqual(public - {'maxlen'}, _READ_ONLY_METHODS[table] | _MUTATING_METHODS[table])
+        self.assertEqual(_READ_ONLY_METHODS['numpy.ndarray'] & _MUTATING_METHODS['numpy.ndarray'], frozenset())
+
+    def test_collection_unknown_method(self):
+        class Shuffled(list):
+            def shuffle(self):
+                self.reverse()
+
+        class Holder:
+            @CachedProperty('target', is_collection=True)
+            def items(self):
+                return Shuffled([1, 2, 3])
+
+            @CachedProperty()
+            def target(self):
+                return list(self.items)
+
+        h = Holder()
+        self.assertEqual(h.target, [1, 2, 3])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            h.items.count(1)
+            self.assertEqual(caught, [])
+            h.items.shuffle()
+        self.assertIn('Shuffled.shuffle', str(caught[0].message))
+        self.assertEqual(h.target, [3, 2, 1])
+
+    def test_collection_reads_dont_invalidate(self):
+        i = CollectionProperties()
+
+        def check_read(f):
+            self.assertTrue(i.target)
+            f()
+            self.assertFalse(i._need_target)
+
+        check_read(lambda: list(i.basic_dict.keys()))
+        check_read(lambda: list(i.basic_dict.items()))
+        check_read(lambda: list(i.basic_dict.values()))
+        check_read(lambda: i.basic_defaultdict.items())
+        check_read(lambda: i.basic_list.index(2))
+        check_read(lambda: i.basic_list.count(2))
+        check_read(lambda: i.basic_set.issubset({1, 2, 3, 4}))
+        check_read(lambda: i.basic_set.isdisjoint({5}))
+        check_read(lambda: i.basic_deque.count(1))
+        check_read(lambda: i.basic_deque.maxlen)
+        check_read(lambda: i.basic_array.sum())
+        check_read(lambda: i.basic_array.argsort())
+        check_read(lambda: i.basic_array.shape)
+        check_read(lambda: i.locked_dict.keys())
+
+    def test_collection_writes_invalidate(self):
+        i = CollectionProperties()
+
+        def check_write(f):
+            self.assertTrue(i.target)
+            f()
+            self.assertTrue(i._need_target)
+
+        check_write(lambda: i.basic_list.append(4))
+        check_write(lambda: i.basic_list.sort())
+        check_write(lambda: i.basic_set.add(4))
+        check_write(lambda: i.basic_dict.setdefault('z', 0))
+        check_write(lambda: i.basic_deque.appendleft(0))
+        check_write(lambda: i.basic_deque.rotate(1))
+        check_write(lambda: i.basic_array.reshape(3, 1))  # A view, which could be written through
+        check_write(lambda: i.basic_array.T)
+        check_write(lambda: i.basic_array.flat)
+        check_write(lambda: i.basic_array.sort())
+        check_write(lambda: i.basic_array.fill(0))
+        self.assertEqual(list(i.basic_array), [0, 0, 0])
+        self.assertRaises(AttributeError, i.locked_set.add, 4)
+        self.assertRaises(AttributeError, getattr, CachedCollection(np.zeros(3), None, i, False), 'T')
+
+    def test_batch(self):
+        b = Batched()
+        self.assertEqual(b.total, 0)
+        with CachedProperty.batch(b):
+            for i in range(100):
+                b.items.append(i)
+            with CachedProperty.batch(b):
+                b.offset = 1
+            self.assertEqual(b.invalidations, 0)
+            self.assertFalse(b._need_total)
+        self.assertEqual(b.invalidations, 1)
+        self.assertTrue(b._need_total)
+        self.assertEqual(b.total, 4951)
+
+        # Invalidations are still applied if the block fails
+        try:
+            with CachedProperty.batch(b):
+                b.items.append(1)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(b.invalidations, 2)
+        self.assertEqual(b.total, 4952)
+
+        b.items.append(1)
+        self.assertEqual(b.invalidations, 3)
+
+    def test_incremental(self):
+        r = RunningTotal()
+        self.assertEqual(r.mean, 2)
+        r.items.append(6)
+        self.assertTrue(r._need_count)
+        self.assertTrue(r._need_mean)
+        r.items[0] = 5
+        del r.items[1]
+        self.assertEqual(r.total, 14)
+        self.assertEqual((r.recomputes, r.updates), (1, 1))
+        self.assertEqual(r.mean, 14 / 3)
+
+        # Unrecognized changes can still fall back to recomputing
+        r.items.sort()
+        self.assertEqual(r.total, 14)
+        self.assertEqual(r.updates, 2)
+
+        # Replacing the collection, or mutating it before the total is cached, recomputes from scratch
+        r.items = [1]
+        r.items.append(1)
+        self.assertEqual(r.total, 2)
+        self.assertEqual((r.recomputes, r.updates), (2, 2))
+
+        # Mutations made in a batch are logged together
+        with CachedProperty.batch(r):
+            for i in range(10):
+                r.items.append(i)
+        self.assertEqual(r.total, 47)
+        self.assertEqual((r.recomputes, r.updates), (2, 3))
+
+    def test_async_single_flight(self):
+        async def run():
+            a = AsyncSource()
+            results = await asyncio.gather(*[a.value for _ in range(10)])
+            self.assertEqual(results, [1] * 10)
+            self.assertEqual(a.fetches, 1)
+            self.assertEqual(await a.value, 1)
+            self.assertEqual(a._value, 1)
+            self.assertEqual(await a.doubled, 2)
+
+            del a.value
+            self.assertTrue(a._need_doubled)
+            self.assertEqual(await a.doubled, 4)
+            a.value = 10
+            self.assertEqual(await a.doubled, 20)
+
+        asyncio.run(run())
+
+    def test_async_errors_and_invalidation(self):
+        async def run():
+            a = AsyncSource()
+            a.fail = True
+            with self.assertRaises(ValueError):
+                await a.value
+            a.fail = False
+            self.assertEqual(await a.value, 2)
+
+            # A value invalidated mid-computation isn't cached
+            del a.value
+            pending = asyncio.ensure_future(a.value)
+            await asyncio.sleep(0)
+            del a.value
+            self.assertEqual(await pending, 3)
+            self.assertEqual(await a.value, 4)
+
+        asyncio.run(run())
+
+    def test_warm_threads(self):
+        from time import perf_counter
+
+        p = Pipeline()
+        start = perf_counter()
+        self.assertIs(warm(p, 'total'), p)
+        elapsed = perf_counter() - start
+        self.assertLess(elapsed, 0.35)
+        self.assertEqual(p._total, 60)
+        self.assertFalse(hasattr(p, '_doubled'))
+
+        warm(p)
+        self.assertEqual(p._doubled, [20] * 3)
+        self.assertRaises(AttributeError, warm, p, 'missing')
+
+    def test_warm_processes(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        p = ProcessPipeline()
+        with ProcessPoolExecutor(2) as executor:
+            warm(p, executor=executor)
+        self.assertEqual(p._total, 55)
+        self.assertEqual(list(p._b), list(range(10)))
+        del p.a
+        self.assertTrue(p._need_total)
+
+    def test_ttl(self):
+        e = Expiring()
+        self.assertEqual(e.doubled, 2)
+        self.assertEqual(e.value, 1)
+        # Dependents are invalidated in the background when their source expires
+        sleep(0.2)
+        self.assertTrue(e._need_doubled)
+        self.assertEqual(e.value, 2)
+        self.assertEqual(e.doubled, 4)
+        self.assertRaises(ValueError, CachedProperty(stale_while_revalidate=1), lambda self: 1)
+
+    def test_stale_while_revalidate(self):
+        e = Expiring()
+        self.assertEqual(e.slow, 1)
+        sleep(0.15)
+        start = perf_counter()
+        for _ in range(10):
+            self.assertEqual(e.slow, 1)
+        self.assertLess(perf_counter() - start, 0.05)
+        sleep(0.15)
+        self.assertEqual(e.refreshes, 2)
+        self.assertEqual(e.slow, 2)
+
+    def test_pickle(self):
+        s = Shippable()
+        self.assertEqual((s.total, s.label, s.computes), (6, 'shippable', 2))
+        s.scratch
+        self.assertIn('_lock_total', vars(s))
+
+        t = pickle.loads(pickle.dumps(s))
+        self.assertEqual((t.total, t.label, t.computes), (6, 'shippable', 2))
+        self.assertNotIn('_scratch', vars(t))
+        self.assertTrue(t._need_scratch)
+        self.assertEqual(t.scratch, [0] * 10)
+
+        # The restored collection invalidates the copy's dependents, not the original's
+        t.items.append(4)
+        self.assertTrue(t._need_total)
+        self.assertFalse(s._need_total)
+        self.assertEqual(t.total, 10)
+
+        u = SlottedShippable(3)
+        self.assertEqual(u.square, 9)
+        v = pickle.loads(pickle.dumps(u))
+        self.assertEqual((v.n, v._cached_values[1:]), (3, [9]))
+
+    def test_copy(self):
+        s = Shippable()
+        s.total
+        for c in (copy.copy(s), copy.deepcopy(s)):
+            self.assertEqual(c._total, 6)
+            self.assertIsNot(Shippable.total.storage.lock(c), Shippable.total.storage.lock(s))
+            self.assertIsNot(c.items, s.items)
+        c = copy.deepcopy(s)
+        c.items[0] = 0
+        self.assertEqual((c.total, s.total), (5, 6))
+
+    def test_fork(self):
+        if not hasattr(os, 'fork'):
+            return
+        s = Shippable()
+        held, release = Barrier(2), Barrier(2)
+
+        def hold():
+            with Shippable.total.storage.lock(s):
+                held.wait()
+                release.wait()
+
+        thread = Thread(target=hold)
+        thread.start()
+        held.wait()
+        pid = os.fork()
+        if pid == 0:
+            # The lock held by the parent's other thread must not deadlock the child
+            signal.alarm(5)
+            os._exit(0 if s.total == 6 else 1)
+        release.wait()
+        thread.join()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_stats(self):
+        fast = Instrumented.fast.cached_property
+        slow = Instrumented.slow.cached_property
+        self.assertIn(slow, CachedProperty.caches)
+        CachedProperty.collect_stats()
+        try:
+            objs = [Instrumented() for _ in range(2)]
+            for o in objs:
+                for _ in range(5):
+                    o.slow
+            self.assertEqual((slow.stats.hits, slow.stats.misses), (8, 2))
+            self.assertGreaterEqual(slow.stats.max_time, 0.02)
+            self.assertEqual(slow.stats.memory, 1600)
+            self.assertAlmostEqual(slow.stats.time_saved, 8 * slow.stats.mean_time)
+
+            objs[0].fast
+            del objs[0].fast
+            self.assertEqual(fast.stats.invalidations, 1)
+            self.assertEqual(slow.stats.invalidations, 1)
+            self.assertEqual(slow.stats.memory, 800)
+            del objs[1], o
+            self.assertEqual(slow.stats.memory, 0)
+
+            report = CachedProperty.report().split('\n')
+            self.assertIn('Instrumented.slow', report[1])
+            self.assertIn('Instrumented.fast', CachedProperty.report(sort_by='wasted'))
+            self.assertEqual(len(CachedProperty.report(top=1).split('\n')), 2)
+        finally:
+            CachedProperty.collect_stats(False)
+            slow.stats.reset()
+            fast.stats.reset()
+        Instrumented().slow
+        self.assertEqual(slow.stats.misses, 0)
+
+    def test_stats_threaded_hits(self):
+        fast = Instrumented.fast.cached_property
+        o = Instrumented()
+        o.fast
+        CachedProperty.collect_stats()
+        try:
+            def read():
+                for _ in range(2000):
+                    o.fast
+
+            threads = [Thread(target=read) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(fast.stats.hits, 16000)
+        finally:
+            CachedProperty.collect_stats(False)
+            fast.stats.reset()
+        self.assertEqual(fast.stats.hits, 0)
@@ -1,3 +1,5 @@
+import io
+import logging
 import sys
 from unittest import TestCase
 
@@ -44,3 +46,131 @@ class TestLogging(TestCase):
             print(">>> {} <<<".format(log_files), file=sys.__stderr__)
             self.assertIn('TEST', log_files)
 
+
+
+    def test_async_handlers(self):
+        from miniutils.logs import enable_logging, disable_logging
+        import miniutils.logs_base as logger
+
+        with captured_output() as (out, err):
+            log = enable_logging(use_colors=False, format_str=r'%(levelname)s|%(message)s', async_handlers=True)
+            for i in range(100):
+                logger.warning('__%d__', i)
+            disable_logging()  # Waits for the queue to be written out
+        self.assertEqual(err().strip().split('\n'), ['WARNING|__{}__'.format(i) for i in range(100)])
+        self.assertNotIn('queue_handler', [handler.name for handler in log.handlers])
+
+    def test_async_handlers_format_in_listener(self):
+        import threading
+        from miniutils.logs import enable_logging, disable_logging
+
+        class Recorder:
+            def __str__(self):
+                threads.append(threading.current_thread())
+                return '__recorded__'
+
+        threads = []
+        with captured_output() as (out, err):
+            log = enable_logging(use_colors=False, format_str=r'%(message)s', async_handlers=True)
+            log.warning('%s', Recorder())
+            disable_logging()
+        self.assertEqual(err().strip(), '__recorded__')
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_async_handlers_drop(self):
+        import logging
+        from queue import Queue
+        from miniutils.logs import _make_queue_handler
+
+        handler = _make_queue_handler(Queue(maxsize=2), 'drop')
+        for i in range(5):
+            handler.handle(logging.makeLogRecord({'msg': str(i)}))
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual([handler.queue.get().msg for _ in range(2)], ['0', '1'])
+
+        import miniutils.logs
+        with captured_output() as (out, err):
+            enable_logging = miniutils.logs.enable_logging
+            enable_logging(use_colors=False, format_str=r'%(levelname)s|%(message)s', async_handlers=True,
+                           when_full='drop')
+            miniutils.logs._queue_handler.dropped = 3
+            miniutils.logs.disable_logging()
+        self.assertEqual(err().strip(), 'WARNING|3 log records were dropped because the logging queue was full')
+
+    def test_async_handlers_fork(self):
+        import os
+        import tempfile
+        from time import sleep
+        from miniutils.logs import enable_logging, disable_logging
+
+        if not hasattr(os, 'fork'):
+            return
+        with tempfile.TemporaryDirectory() as d, captured_output():
+            enable_logging(logdir=d, use_colors=False, format_str=r'%(message)s', async_handlers=True, queue_size=10)
+            pid = os.fork()
+            if not pid:
+                # More records than the queue can hold, which would block forever without a listener
+                for i in range(50):
+                    logging.warning('__child %d__', i)
+                os._exit(0)
+            for _ in range(500):
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    break
+                sleep(0.01)
+            else:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                self.fail("The forked child hung while logging")
+            disable_logging()
+            with open(os.path.join(d, 'app.log')) as f:
+                self.assertEqual(f.read().split('\n')[:-1], ['__child {}__'.format(i) for i in range(50)])
+
+
+    def test_lazy_messages(self):
+        from miniutils.logs import enable_logging, disable_logging
+        import miniutils.logs_base as logger
+
+        def expensive():
+            calls.append(1)
+            return '__expensive__'
+
+        calls = []
+        with captured_output() as (out, err):
+            enable_logging('WARNING', use_colors=False, format_str=r'%(levelname)s|%(message)s')
+            self.assertFalse(logger.is_enabled_for('DEBUG'))
+            self.assertTrue(logger.is_enabled_for(logging.ERROR))
+            logger.debug(expensive)
+            logger.debug('__%s__', 'skipped')
+            logger.error(expensive)
+            logger.error('__%s__', 'formatted')
+            disable_logging()
+            self.assertTrue(logger.is_enabled_for('DEBUG'))
+            logger.debug(expensive)
+            logger.debug('__%d__', 4)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(err().strip().split('\n'),
+                         ['ERROR|__expensive__', 'ERROR|__formatted__', '__expensive__', '__4__'])
+
+    def test_stderr_batching(self):
+        from time import sleep
+        from miniutils.logs_base import _StderrWriter
+
+        writer = _StderrWriter(max_delay=0.1)
+        writer.batch = True
+        raw = io.BytesIO()
+        stderr, stream = sys.__stderr__, io.TextIOWrapper(io.BufferedWriter(raw), write_through=True)
+        sys.__stderr__ = sys.stderr = stream
+        try:
+            writer.write('a', logging.DEBUG)
+            stream.write('direct\n')
+            writer.write('b', logging.INFO)
+            self.assertEqual(raw.getvalue(), b'')
+            sleep(0.3)  # The timer flushes everything, in the order it was written
+            self.assertEqual(raw.getvalue(), b'a\ndirect\nb\n')
+            writer.write('c', logging.DEBUG)
+            writer.write('d', logging.WARNING)  # Warnings go out right away, after anything unflushed
+            self.assertEqual(raw.getvalue(), b'a\ndirect\nb\nc\nd\n')
+            self.assertIsNone(writer.timer)
+        finally:
+            sys.__stderr__ = sys.stderr = stderr
@@ -1,5 +1,8 @@
+import multiprocessing as mp
+from time import sleep
 from unittest import TestCase
-from miniutils.progress_bar import progbar, parallel_progbar, iparallel_progbar
+from miniutils.progress_bar import progbar, parallel_progbar, iparallel_progbar, parallel_first, parallel_any, \
+    parallel_all
 
 
 class TestProgbar(TestCase):
@@ -110,3 +113,56 @@ class TestProgbar(TestCase):
 
         self.assertSequenceEqual(f_flat([1, 2, 3]), [0, 0, 1, 0, 1, 2])
         self.assertRaises(TypeError, f_flat, ['a', 'b', 'c'])
+
+    def test_iparallel_progbar_close_cancels(self):
+        processed = mp.Value('i', 0)
+
+        def mapper(i):
+            with processed.get_lock():
+                processed.value += 1
+            sleep(0.05)
+            return i
+
+        gen = iparallel_progbar(mapper, range(200), nprocs=2, verbose=False)
+        next(gen)
+        gen.close()
+        count = processed.value
+        sleep(0.3)
+        self.assertEqual(processed.value, count)
+        self.assertLess(count, 200)
+
+    def test_iparallel_progbar_break(self):
+        def mapper(i):
+            sleep(0.01)
+            return i
+
+        for x in iparallel_progbar(mapper, range(1000), nprocs=2, verbose=False):
+            if x >= 5:
+                break
+        # A fresh mapping still works normally afterwards
+        self.assertSequenceEqual(parallel_progbar(mapper, range(10), verbose=False), list(range(10)))
+
+    def test_parallel_first(self):
+        def mapper(i):
+            return i * 3
+
+        self.assertEqual(parallel_first(lambda y: y % 7 == 0 and y > 0, mapper, range(100)), 21)
+        self.assertEqual(parallel_first(lambda y: y % 7 == 0 and y > 0, mapper, range(100), shuffle=True), 21)
+        self.assertIsNone(parallel_first(lambda y: y < 0, mapper, range(100)))
+        self.assertEqual(parallel_first(lambda y: y < 0, mapper, range(100), default=-1), -1)
+
+    def test_parallel_first_starmap(self):
+        def mapper(a, b):
+            return a * b
+
+        self.assertEqual(parallel_first(lambda y: y > 10, mapper, [(1, 2), (3, 4), (5, 6)], starmap=True), 12)
+
+    def test_parallel_any_all(self):
+        def mapper(i):
+            return i % 50 != 49
+
+        self.assertTrue(parallel_any(mapper, range(100)))
+        self.assertFalse(parallel_all(mapper, range(100)))
+        self.assertTrue(parallel_all(mapper, range(49)))
+        self.assertFalse(parallel_any(lambda i: False, range(10)))
+        self.assertTrue(parallel_all(lambda i: True, []))
@@ -1,9 +1,27 @@
-from time import sleep
+import asyncio
+import gc
+import inspect
+import io
+import json
+import os
+import re
+from threading import Thread
+from time import perf_counter, sleep
+import tracemalloc
 from unittest import TestCase
 import sys
 
 from miniutils.capture_output import captured_output
-from miniutils.timing import timed_call, make_timed, tic
+from miniutils.progress_bar import parallel_progbar
+from miniutils import timing
+from miniutils.timing import timed_call, make_timed, tic, TimingStats, report, dump, reset_stats
+
+
+def traced_work(x):
+    with timing.section('work'):
+        with timing.section('inner'):
+            sleep(0.01)
+    return x
 
 
 class TestTiming(TestCase):
@@ -32,6 +50,321 @@ class TestTiming(TestCase):
         out = err()
         self.assertRegex(out, r'0\.1\d+s')
 
+    def test_make_timed_aggregate(self):
+        @make_timed(aggregate=True)
+        def h(a):
+            sleep(0.01 if a else 0)
+            return a
+
+        with captured_output() as (out, err):
+            for i in range(100):
+                self.assertEqual(h(int(i >= 90)), int(i >= 90))
+        self.assertEqual(err(), '')
+        self.assertEqual(h.__name__, 'h')
+
+        st = h.timing_stats
+        self.assertEqual(st.count, 100)
+        self.assertLess(st.p50, 0.005)
+        self.assertGreaterEqual(st.p95, 0.009)
+        self.assertGreaterEqual(st.max, st.p99)
+        self.assertAlmostEqual(st.mean, st.total / 100)
+
+        self.assertIn(st.name, report().split('\n')[1])
+        f = io.StringIO()
+        self.assertEqual(json.loads(json.dumps(dump()))[st.name]['count'], 100)
+        dump(f)
+        self.assertEqual(json.loads(f.getvalue())[st.name]['count'], 100)
+        reset_stats()
+        self.assertEqual(st.count, 0)
+
+    def test_make_timed_methods(self):
+        class Widget:
+            scale = 3
+
+            @make_timed(aggregate=True)
+            def method(self, x):
+                return self.scale * x
+
+            @make_timed(aggregate=True)
+            @classmethod
+            def klass(cls, x):
+                return cls.scale * x
+
+            @make_timed
+            @staticmethod
+            def static(x):
+                return x
+
+        w = Widget()
+        self.assertEqual(w.method(2), 6)
+        self.assertEqual(Widget.klass(2), 6)
+        self.assertEqual(w.klass(2), 6)
+        with captured_output() as (out, err):
+            self.assertEqual(w.static(2), 2)
+            self.assertEqual(Widget.static(2), 2)
+        self.assertEqual(len(err().strip().split('\n')), 2)
+        self.assertEqual(Widget.method.__name__, 'method')
+        self.assertEqual(Widget.method.__wrapped__(w, 1), 3)
+        self.assertEqual(Widget.method.timing_stats.count, 1)
+        self.assertEqual(Widget.klass.timing_stats.count, 2)
+
+    def test_make_timed_sampled(self):
+        @make_timed(aggregate=True, sample=10)
+        def f(x):
+            return x
+
+        self.assertEqual([f(i) for i in range(95)], list(range(95)))
+        self.assertEqual(f.timing_stats.count, 10)
+
+    def test_make_timed_coroutine(self):
+        @make_timed(aggregate=True)
+        async def fetch(x):
+            await asyncio.sleep(0.05)
+            return x
+
+        self.assertTrue(inspect.iscoroutinefunction(fetch))
+        self.assertEqual(asyncio.run(fetch(3)), 3)
+        self.assertEqual(fetch.timing_stats.count, 1)
+        self.assertGreaterEqual(fetch.timing_stats.max, 0.045)
+        self.assertGreaterEqual(fetch.timing_breakdown['suspended'].max, 0.045)
+        self.assertLess(fetch.timing_breakdown['running'].max, 0.01)
+
+    def test_make_timed_generator(self):
+        @make_timed(aggregate=True)
+        def produce(n):
+            for i in range(n):
+                sleep(0.01)
+                got = yield i
+                if got is not None:
+                    yield got
+
+        out = []
+        for x in produce(5):
+            out.append(x)
+            sleep(0.02)
+        self.assertEqual(out, list(range(5)))
+        st, parts = produce.timing_stats, produce.timing_breakdown
+        self.assertEqual(st.count, 1)
+        self.assertGreaterEqual(st.max, 0.14)
+        self.assertEqual(parts['per item'].count, 5)
+        self.assertGreaterEqual(parts['first item'].max, 0.009)
+        self.assertLess(parts['first item'].max, 0.02)
+        self.assertGreaterEqual(parts['suspended'].max, 0.09)
+
+        # Values sent in are passed along, and closing it early still records the call
+        g = produce(10)
+        self.assertEqual(next(g), 0)
+        self.assertEqual(g.send('x'), 'x')
+        g.close()
+        self.assertEqual((st.count, parts['per item'].count), (2, 7))
+
+        with captured_output() as (out, err):
+            self.assertEqual(list(make_timed(produce.__wrapped__)(2)), [0, 1])
+        self.assertIn('2 items', err())
+
+    def test_make_timed_async_generator(self):
+        @make_timed(aggregate=True)
+        async def ticks(n):
+            for i in range(n):
+                await asyncio.sleep(0.01)
+                yield i
+
+        async def consume():
+            return [x async for x in ticks(3)]
+
+        self.assertTrue(inspect.isasyncgenfunction(ticks))
+        self.assertEqual(asyncio.run(consume()), [0, 1, 2])
+        parts = ticks.timing_breakdown
+        self.assertEqual(ticks.timing_stats.count, 1)
+        self.assertEqual(parts['per item'].count, 3)
+        self.assertGreaterEqual(parts['per item'].p50, 0.009)
+        self.assertGreaterEqual(parts['suspended'].max, 0.027)
+
+    def test_probes(self):
+        def churn(n):
+            data = [bytearray(1000) for _ in range(n)]
+            gc.collect()
+            return len(data)
+
+        with captured_output() as (out, err):
+            self.assertEqual(timed_call(churn, 1000, probes=True), 1000)
+        line = err()
+        for name in ('cpu', 'thread_cpu', 'alloc_net', 'alloc_peak', 'gc', 'gc_pause', 'rss'):
+            self.assertRegex(line, r'[ \[]{}='.format(name))
+        self.assertGreaterEqual(int(re.search(r'alloc_peak=\+(\d+)B', line).group(1)), 1000000)
+        self.assertGreaterEqual(int(re.search(r' gc=(\d+)', line).group(1)), 1)
+
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, timed_call, fail, probes='alloc')
+        self.assertFalse(tracemalloc.is_tracing())
+
+        @make_timed(aggregate=True, probes=('cpu', 'gc'))
+        def collect():
+            gc.collect()
+
+        collect()
+        collect()
+        st = collect.timing_stats
+        self.assertGreaterEqual(st.probes['gc'][0], 2)
+        self.assertEqual(set(st.summary()['probes']), {'cpu', 'gc', 'gc_pause'})
+        self.assertIn('gc_pause', report())
+        self.assertRaises(ValueError, make_timed(probes='bogus'), churn)
+
+        with captured_output() as (out, err):
+            toc = tic(fmt='{message}', probes='cpu')
+            toc('x')
+        self.assertRegex(err(), r'x \[cpu=\d')
+
+        # tic never leaves tracemalloc running: its caller has to start it
+        self.assertRaises(ValueError, tic, probes='alloc')
+        with captured_output() as (out, err):
+            tic(fmt='{message}', probes=True)('x')
+        self.assertNotIn('alloc', err())
+        self.assertFalse(tracemalloc.is_tracing())
+        tracemalloc.start()
+        try:
+            with captured_output() as (out, err):
+                toc = tic(fmt='{message}', probes='alloc')
+                toc('x')
+                toc('y')
+        finally:
+            tracemalloc.stop()
+        self.assertRegex(err(), r'y \[alloc_net=')
+
+    def test_timing_disabled(self):
+        def f(x):
+            return x
+
+        timing.set_enabled(False)
+        try:
+            self.assertIs(make_timed(f), f)
+            self.assertIs(make_timed(aggregate=True)(f), f)
+            with captured_output() as (out, err):
+                self.assertEqual(timed_call(f, 1), 1)
+            self.assertEqual(err(), '')
+        finally:
+            timing.set_enabled(True)
+        self.assertIsNot(make_timed(f), f)
+
+    def test_timing_stats_percentiles(self):
+        st = TimingStats('uniform')
+        for ns in range(1, 100001):
+            st.record(ns * 1000)
+        for q in (50, 95, 99):
+            self.assertAlmostEqual(st.percentile(q), q / 1000, delta=q / 1000 * 0.04)
+        self.assertLess(len(st.buckets), 500)
+        self.assertEqual(st.max, 0.1)
+
+    def test_sections(self):
+        timing.reset_sections()
+
+        @timing.section()
+        def parse(x):
+            sleep(0.01)
+            return x
+
+        with timing.section('load'):
+            sleep(0.02)
+            for i in range(3):
+                self.assertEqual(parse(i), i)
+        with timing.section('load'):
+            with timing.section():
+                pass
+
+        lines = timing.section_report().split('\n')
+        self.assertEqual(len(lines), 4)
+        name, calls, total, self_time = lines[1].split()
+        self.assertEqual((name, calls), ('load', '2'))
+        self.assertGreaterEqual(float(total), 0.05)
+        self.assertLess(float(self_time), float(total))
+        self.assertGreaterEqual(float(self_time), 0.02)
+        self.assertIn('  {}'.format(parse.__qualname__), lines[2])
+        self.assertRegex(lines[3], r'^  test_timing\.py:\d+ +1 ')
+
+        self.assertEqual(len(timing.section_report(min_fraction=0.1).split('\n')), 3)
+        timing.reset_sections()
+        self.assertEqual(len(timing.section_report().split('\n')), 1)
+
+    def test_trace(self):
+        with timing.Trace() as trace:
+            with timing.section('main'):
+                self.assertEqual(parallel_progbar(traced_work, range(8), nprocs=2, verbose=False), list(range(8)))
+                thread = Thread(target=traced_work, args=(0,))
+                thread.start()
+                thread.join()
+        self.assertNotIn('MINIUTILS_TRACE_DIR', os.environ)
+
+        paths = {(path, pid) for path, _, _, pid, _ in trace.spans}
+        workers = {pid for path, pid in paths if path == ('main', 'work', 'inner')}
+        self.assertGreaterEqual(len(workers), 1)
+        self.assertNotIn(os.getpid(), workers)
+        self.assertIn((('work', 'inner'), os.getpid()), paths)
+        self.assertIn((('main',), os.getpid()), paths)
+        self.assertEqual(len({tid for _, _, _, pid, tid in trace.spans if pid == os.getpid()}), 2)
+
+        events = json.loads(json.dumps(trace.chrome_trace()))['traceEvents']
+        self.assertEqual(len(events), len(trace.spans))
+        self.assertEqual(sum(e['name'] == 'inner' for e in events), 9)
+        self.assertTrue(all(e['dur'] >= 0 and e['ph'] == 'X' for e in events))
+
+        f = io.StringIO()
+        trace.write_collapsed(f)
+        stacks = dict(line.rsplit(' ', 1) for line in f.getvalue().strip().split('\n'))
+        self.assertGreaterEqual(int(stacks['main;work;inner']), 80000)
+        self.assertIn('work;inner', stacks)
+
+    def test_disabled_log_level(self):
+        from miniutils.logs import enable_logging, disable_logging
+
+        with captured_output() as (out, err):
+            enable_logging('INFO', use_colors=False)
+            timed_call(sleep, 0.001)
+            make_timed(sleep)(0.001)
+            tic()('skipped')
+            disable_logging()
+        self.assertEqual(err(), '')
+
+    def test_sample_profile(self):
+        def spin(seconds):
+            end = perf_counter() + seconds
+            while perf_counter() < end:
+                pass
+
+        def caller():
+            spin(0.2)
+
+        with timing.sample_profile(interval=0.001) as profile:
+            caller()
+        (label, self_count, total), = [row for row in profile.top() if row[0].startswith('spin ')]
+        self.assertGreater(self_count, 0.5 * sum(profile.counts.values()))
+        self.assertIn('test_timing.py', label)
+        self.assertRegex(profile.collapsed(), r'caller \(test_timing\.py:\d+\);spin \(test_timing\.py:\d+\) \d+')
+        self.assertEqual(profile.top(1)[0][0], label)
+        self.assertRegex(profile.report(), r'\d+ samples over 0\.2\d*s')
+        self.assertLess(profile.overhead_ns, 0.5 * profile.elapsed_ns)
+
+        # Other threads are only sampled when asked for
+        thread = Thread(target=spin, args=(0.3,), name='spinner')
+        thread.start()
+        with timing.sample_profile(interval=0.001, all_threads=True) as profile:
+            sleep(0.1)
+        thread.join()
+        self.assertTrue(any(stack[0] == 'spinner' and stack[-1].startswith('spin ') for stack in profile.stacks()))
+        self.assertTrue(any(stack[-1].startswith('test_sample_profile ') for stack in profile.stacks()))
+
+        profiled = timing.sample_profile(interval=0.001)(spin)
+        profiled(0.05)
+        profiled(0.05)
+        self.assertAlmostEqual(profiled.profile.elapsed_ns / 1e9, 0.1, delta=0.05)
+        self.assertTrue(any(row[0].startswith('spin ') for row in profiled.profile.top()))
+
+        if hasattr(timing.signal, 'setitimer'):
+            with timing.sample_profile(interval=0.001, clock='cpu') as profile:
+                spin(0.2)
+            self.assertTrue(any(row[0].startswith('spin ') for row in profile.top(3)))
+
     def test_tic(self):
         with captured_output() as (out, err):
             toc = tic(fmt='__{message}:{diff:0.1f}:{total:0.1f}__')